@@ -6,12 +6,14 @@ export LC_ALL=C
 DO_MAKE=1  # measure the compilation time scaling
 COMPILER_CONFIG="benchmarking"  # for the setup script it means "./compilers/../benchmarking/${COMPILER_CONFIG}.in"
 N_PROC_LIST=""
+PROFILE_BUILD=0  # record per-file compile times
 
 usage() {
     echo "Usage:   $0 [options] [n_threads_1 [n_threads_2 ...]]"
     echo "         -h | --help : this message"
     echo "         -f | --fast : skip compilation test if possible"
     echo "         -c | --config file : use ./benchmarking/\${file}.in as the compiler config (default: ./benchmarking/benchmarking.in)"
+    echo "         -p | --profile-build : report the slowest files of each multi-thread make (see python/build_profile.py)"
     echo "default: $0 \$( seq number_of_logical_CPUs )"
     exit 1
 }
@@ -23,6 +25,10 @@ parse_arguments() {
                 DO_MAKE=0
                 shift
                 ;;
+            -p|--profile-build)
+                PROFILE_BUILD=1
+                shift
+                ;;
             -h|--help)
                 usage
                 ;;
@@ -73,7 +79,13 @@ awkfor() {
 make_objects() {
     local obj_list=$1
     make $obj_list CL=1 > /dev/null
+    [ $PROFILE_BUILD == 1 ] && for obj in $obj_list; do rm -f $obj/build_times.log; done
     ( time make -j $obj_list > /dev/null ) 2>&1 | awkfor
+    if [ $PROFILE_BUILD == 1 ] ; then
+        for obj in $obj_list; do
+            python3 python/build_profile.py -n 5 -b 0 $obj | sed 's/^/## /'
+        done
+    fi
 }
 
 setup_flood_scaling() {
@@ -353,6 +365,7 @@ if [ $DO_MAKE == 1 ]; then
     {
         echo -n "Preparing objects                "
         SETUP_PARAMS="-c ../benchmarking/${COMPILER_CONFIG} -n --linkexe -d BENCHMARKING_HACK"
+        [ $PROFILE_BUILD == 1 ] && SETUP_PARAMS="$SETUP_PARAMS --timebuild"
         ( time for problem in "${PROBLEM_LIST[@]}"; do
             ./setup $problem $SETUP_PARAMS -o "B_$problem" > /dev/null
         done ) 2>&1 | awkfor
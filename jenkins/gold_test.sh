@@ -34,8 +34,10 @@ RUN_TEST_DIR=${TEST_DIR}runs/$(basename ${PROBLEM_NAME})/
 RUN_GOLD_DIR=${GOLD_DIR}runs/$(basename ${PROBLEM_NAME})/
 
 GOLD_LOG=${OUT_DIR}gold_log
+GOLD_JSON=${OUT_DIR}gold.json
 GOLD_CSV=${OUT_DIR}gold.csv
 RIEM_LOG=${OUT_DIR}riem_log
+RIEM_JSON=${OUT_DIR}riem.json
 RIEM_CSV=${OUT_DIR}riem.csv
 GOLD_SHA_FILE=${OUT_DIR}__sha__
 
@@ -157,23 +159,27 @@ fi
 wait
 # Here background jobs should be finished
 
-./bin/gdf_distance ${RUN_GOLD_DIR}${OUTPUT} ${RUN_TEST_DIR}${OUTPUT} 2>&1 | tee $GOLD_LOG
-grep 'Difference of datafield `' $GOLD_LOG |\
-    sed 's/.*`\([^ ]*\)[^ ] *: \(.*\)/\1 \2/' |\
-    awk '{a[$1]=$2} END {for (i in a) printf("log10(%s),", i); print ""; for (i in a) printf("%s,", (a[i]>0.)?(log(a[i])/log(10.)):1.) ; print ""}' |\
-    sed 's/,$//' |\
-    tee $GOLD_CSV
+# Datafield distances on the base level from gdf_distance JSON report as log10 values, log10(0.) mapped to 1.
+log10_csv() {
+    [ -e $1 ] && python3 -c '
+import json, math, sys
+d = json.load(open(sys.argv[1]))["differences"]
+f = sorted([i for i in d if i.startswith("datafield `")])
+print(",".join(["log10(%s)" % i[len("datafield `"):-1] for i in f]))
+print(",".join([("%.6g" % math.log10(d[i][1])) if d[i][1] > 0. else "1" for i in f]))
+' $1
+}
+
+rm -f $GOLD_JSON $RIEM_JSON
+./bin/gdf_distance --json=$GOLD_JSON ${RUN_GOLD_DIR}${OUTPUT} ${RUN_TEST_DIR}${OUTPUT} 2>&1 | tee $GOLD_LOG
+log10_csv $GOLD_JSON | tee $GOLD_CSV
 
 if [ $RIEMANN == 0 ] ; then
     # The tool gdf_distance distance is supposed to return values in [0..1] range
     # Map log10(0.) to 1. and failed Riemann to 2. (both impossible as a results of log10(gdf_distance)
     if [ -e ${RUN_TEST_DIR2}${OUTPUT} ] ; then
-	./bin/gdf_distance ${RUN_TEST_DIR}${OUTPUT} ${RUN_TEST_DIR2}${OUTPUT} 2>&1 | tee $RIEM_LOG
-	grep 'Difference of datafield `' $RIEM_LOG |\
-	    sed 's/.*`\([^ ]*\)[^ ] *: \(.*\)/\1 \2/' |\
-	    awk '{a[$1]=$2} END {for (i in a) printf("log10(%s),", i); print ""; for (i in a) printf("%s,", (a[i]>0.)?(log(a[i])/log(10.)):1.) ; print ""}' |\
-	    sed 's/,$//' |\
-	    tee $RIEM_CSV
+	./bin/gdf_distance --json=$RIEM_JSON ${RUN_TEST_DIR}${OUTPUT} ${RUN_TEST_DIR2}${OUTPUT} 2>&1 | tee $RIEM_LOG
+	log10_csv $RIEM_JSON | tee $RIEM_CSV
     else
 	(
 	    echo "Riemann failed"
@@ -185,4 +191,4 @@ fi
 [ $HAS_KEEPPAR == 1 ] && echo " --keeppar" >> .setuprc
 
 # Fail if gold distance is not 0.
-[ $( ( grep "^Total difference between" $GOLD_LOG || echo 1 ) | awk '{print $NF}' ) == 0 ] || exit 1
+python3 -c 'import json, sys; sys.exit(json.load(open(sys.argv[1])).get("total difference", 1.) != 0.)' $GOLD_JSON 2> /dev/null || exit 1
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import sys
+
+# Summary of per-file compile times logged by bin/compile_timer when the object directory was set up with --timebuild:
+# slowest files, parallelism achieved by make -j and the critical path of the module dependency graph.
+
+from piernik_setup import build_times_file, critical_path, read_build_times, tarjan_scc
+
+
+def read_deps(makefile):
+    # {object: set of objects it depends on} from the dependency lines of obj*/Makefile
+    deps = {}
+    text = open(makefile).read().replace("\\\n", " ")
+    for line in text.split("\n"):
+        m = re.match(r"^(\w+)\.o:(.*)$", line)
+        if m:
+            deps[m.group(1)] = set(d[:-2] for d in m.group(2).split() if d.endswith(".o") and d[:-2] != m.group(1))
+    return deps
+
+
+parser = argparse.ArgumentParser(description="Report compile times recorded with './setup --timebuild' in an object directory")
+parser.add_argument("objdir", help="object directory")
+parser.add_argument("-n", "--top", type=int, default=20, help="show TOP slowest files (default = 20, 0 for all)")
+parser.add_argument("-b", "--bins", type=int, default=20, help="number of time intervals for parallelism (default = 20, 0 to skip)")
+args = parser.parse_args()
+
+times = read_build_times(os.path.join(args.objdir, build_times_file))
+if len(times) == 0:
+    sys.exit("No compile times found in '%s'. Use './setup --timebuild' to record them." % os.path.join(args.objdir, build_times_file))
+
+t_start = min(t[0] for t in times.values())
+t_end = max(t[1] for t in times.values())
+wall = t_end - t_start
+cpu = sum(t[1] - t[0] for t in times.values())
+
+print("Compiled %d files in %.2f s, %.2f s of compilation in total, average parallelism %.2f" % (len(times), wall, cpu, cpu / wall if wall > 0 else 1.))
+
+print("\nSlowest files:")
+slowest = sorted(times, key=lambda f: times[f][0] - times[f][1])
+for f in slowest[:args.top] if args.top > 0 else slowest:
+    print("%10.2f s %6.1f%%  %s" % (times[f][1] - times[f][0], 100. * (times[f][1] - times[f][0]) / cpu if cpu > 0 else 0., f))
+
+if args.bins > 0:
+    print("\nParallelism over time:")
+    dt = wall / args.bins if wall > 0 else 1.
+    for i in range(args.bins):
+        lo, hi = t_start + i * dt, t_start + (i + 1) * dt
+        busy = sum(max(0., min(hi, t[1]) - max(lo, t[0])) for t in times.values()) / dt
+        print("%10.2f s %6.2f  %s" % (i * dt, busy, "#" * int(round(busy * 4))))
+
+deps = {}
+if os.path.isfile(os.path.join(args.objdir, "Makefile")):
+    deps = read_deps(os.path.join(args.objdir, "Makefile"))
+for f in deps:
+    deps[f] = set(d for d in deps[f] if d in deps)
+if len(deps) > 0:
+    weight = dict((f, times[f][1] - times[f][0]) for f in times)
+    length, path = critical_path(deps, tarjan_scc(deps), dict((f, weight.get(f, 0.)) for f in deps))
+    print("\nCritical path: %.2f s (%.1f%% of the build time)" % (length, 100. * length / wall if wall > 0 else 0.))
+    for f in path:
+        print("%10.2f s  %s" % (sum(weight.get(x, 0.) for x in f.split("+")), f))
@@ -1,27 +1,109 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 '''Stupid h5 content comparison script'''
 
+import argparse
 import sys
-from yt.mods import load
+import h5py as h5
+import numpy as np
 
 THRESHOLD = 1e-9
 
-if len(sys.argv) != 3:
-    print("Wrong number of arguments!")
-    sys.exit(-1)
 
-PF1 = load(sys.argv[1])
-PF2 = load(sys.argv[2])
+def datasets(h5f):
+    '''Map "grid/field" (or "grid/particles/type/field") names to datasets of all blocks'''
+    out = {}
+
+    def visit(name, obj):
+        if isinstance(obj, h5.Dataset):
+            out[name] = obj
+
+    h5f['data'].visititems(visit)
+    return out
+
+
+def field_name(dname):
+    '''Strip the grid group from a dataset name'''
+    return dname.split('/', 1)[1]
+
+
+def ordered(a):
+    '''Map floats onto integers that are ordered the same way, so that their difference counts ULPs'''
+    i = a.view('i%d' % a.dtype.itemsize)
+    return np.where(i < 0, np.iinfo(i.dtype).min - i, i)
+
+
+def ulp_distance(a, b):
+    if not np.issubdtype(a.dtype, np.floating):
+        return np.abs(a.astype(np.int64) - b.astype(np.int64))
+    b = b.astype(a.dtype)
+    oa, ob = ordered(a).astype(np.int64), ordered(b).astype(np.int64)
+    # the difference of opposite-sign extremes does not fit in int64, so it is computed modulo 2**64 in uint64
+    ua, ub = oa.view(np.uint64), ob.view(np.uint64)
+    return np.where(oa >= ob, ua - ub, ub - ua)
+
+
+def tolerances(spec):
+    '''Parse FIELD:ATOL[:RTOL] into (FIELD, (ATOL, RTOL))'''
+    parts = spec.split(':')
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError("expected FIELD:ATOL[:RTOL], got '%s'" % spec)
+    return parts[0], (float(parts[1]), float(parts[2]) if len(parts) == 3 else 0.)
 
-DATA1 = PF1.h.all_data()
-DATA2 = PF2.h.all_data()
 
-if not PF1.h.field_list == PF2.h.field_list:
+parser = argparse.ArgumentParser(description="Compare contents of two Piernik HDF5 files block by block")
+parser.add_argument("file", nargs=2, help="HDF5 files to compare")
+parser.add_argument("-a", "--atol", type=float, default=THRESHOLD, help="absolute tolerance (default = %g)" % THRESHOLD)
+parser.add_argument("-r", "--rtol", type=float, default=0., help="relative tolerance (default = 0)")
+parser.add_argument("-f", "--field", type=tolerances, action="append", default=[], metavar="FIELD:ATOL[:RTOL]", help="tolerances for a single field (may be repeated)")
+parser.add_argument("-x", "--exitfirst", action="store_true", help="exit on first field that differs")
+args = parser.parse_args()
+
+F1 = h5.File(args.file[0], 'r')
+F2 = h5.File(args.file[1], 'r')
+
+DS1 = datasets(F1)
+DS2 = datasets(F2)
+
+if sorted(set(field_name(d) for d in DS1)) != sorted(set(field_name(d) for d in DS2)):
     print("Fields in files differ!")
     sys.exit(-1)
 
-for field in PF1.h.field_list:
-    if abs(DATA1[field] - DATA2[field]).max() >= THRESHOLD:
-        print("Field %s differs" % field)
+if sorted(DS1) != sorted(DS2):
+    print("Grid structures in files differ!")
+    sys.exit(-1)
+
+TOL = dict(args.field)
+STATS = {}
+for dname in sorted(DS1):
+    field = field_name(dname)
+    a, b = DS1[dname], DS2[dname]
+    if a.shape != b.shape:
+        print("Shapes of %s differ: %s vs. %s" % (dname, a.shape, b.shape))
         sys.exit(-1)
+    a, b = a[()], b[()]
+    atol, rtol = TOL.get(field, (args.atol, args.rtol))
+    diff = np.abs(a.astype(np.float64) - b.astype(np.float64))
+    ulp = ulp_distance(a, b)
+    s = STATS.setdefault(field, {"max": 0., "ulp_max": 0, "ulp_sum": 0, "n": 0, "ndiff": 0, "fail": 0})
+    if a.size > 0:
+        s["max"] = np.maximum(s["max"], diff.max())  # NaN propagates
+        s["ulp_max"] = max(s["ulp_max"], int(ulp.max()))
+    s["ulp_sum"] += int(np.sum(ulp, dtype=np.float64))
+    s["n"] += a.size
+    s["ndiff"] += np.count_nonzero(ulp)
+    s["fail"] += np.count_nonzero(np.isnan(diff) | ((diff >= atol + rtol * np.abs(b)) & (diff > 0.)))
+    if s["fail"] and args.exitfirst:
+        print("Field %s differs (in %s)" % (field, dname))
+        sys.exit(-1)
+
+FAILED = False
+for field, s in STATS.items():
+    print("%-30s max |diff| = %-12g ULP max = %-12d ULP mean = %-12g differing = %d/%d" %
+          (field, s["max"], s["ulp_max"], s["ulp_sum"] / max(s["n"], 1), s["ndiff"], s["n"]))
+    if s["fail"]:
+        print("Field %s differs" % field)
+        FAILED = True
+
+if FAILED:
+    sys.exit(-1)
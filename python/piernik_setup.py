@@ -1,5 +1,8 @@
 #!/usr/bin/env python3
 
+import copy
+import filecmp
+import hashlib
 import os
 import re
 import shutil
@@ -7,10 +10,12 @@ import sys
 from DirWalk import DirectoryWalker
 import subprocess as sp
 import tempfile
+import time
 from optparse import OptionParser
 
 try:
     import multiprocessing
+    import multiprocessing.pool
     mp = True
 except ImportError:
     print("No multiprocessing: The make command will be run in single thread \
@@ -23,6 +28,11 @@ except ImportError:
     pickle_avail = False
 
 columns = 90
+cpp_cache_dir = '.setup.cppcache'  # results of cpp_scan(), one file per cpp command
+timings_file = '.setup.timings'
+build_times_file = 'build_times.log'  # written in obj directories by bin/compile_timer
+obj_cache_dir = '.setup.objcache'  # objects shared between problems set up with --batch
+default_scale = 2e-3  # guess of compilation time per line of source [s]
 
 is_f90 = re.compile(r"\.f90$", re.IGNORECASE)
 is_header = re.compile(r"\.h$", re.IGNORECASE)
@@ -46,6 +56,7 @@ ECHO ?= /bin/echo
 ifdef CHECK_MAGIC
 \tMV  = /bin/true
 \tF90 = /bin/true
+\tTIME_FC =
 endif
 ifndef PRECOMP
 \tPRECOMP=cpp
@@ -68,10 +79,21 @@ define ECHO_CC
 endef
 endif
 
-CPPFLAGS := $(CPPFLAGS) $(shell $(F90) -c $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/mpi_allgatherv_bug.F90 && $(F90) $(LDFLAGS) -o mpi_allgatherv_bug mpi_allgatherv_bug.o $(LIBS) && mpirun -np 1 ./mpi_allgatherv_bug || echo -DFORBID_F08)
-CPPFLAGS := $(CPPFLAGS) $(shell $(F90) $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/mpi_f08.F90 2> /dev/null && echo -DMPIF08 || echo -DNO_MPIF08_AVAILABLE)
-CPPFLAGS := $(CPPFLAGS) $(shell $(F90) $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/mpi.F90 2> /dev/null || echo -DNO_ALL_MPI_FUNCTIONS_AVAILABLE)
-CPPFLAGS := $(CPPFLAGS) $(shell $(F90) $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/F2018.F90 2> /dev/null || echo -DNO_F2018)
+# Results of the compiler feature probes are kept in .setup.probes.<checksum of compiler, flags and MPI versions>
+PROBES_KEY := $(shell ( $(ECHO) $(F90) $(CPPFLAGS) $(F90FLAGS) $(LDFLAGS) $(LIBS); $(F90) --version 2>&1 | head -n 3; $(F90) -show 2> /dev/null || $(F90) --showme 2> /dev/null; mpirun --version 2>&1 | head -n 3 ) | cksum | cut -d " " -f 1)
+PROBES_CACHE := .setup.probes.$(PROBES_KEY)
+ifeq ("$(wildcard $(PROBES_CACHE))","")
+PROBES := $(shell $(F90) -c $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/mpi_allgatherv_bug.F90 && $(F90) $(LDFLAGS) -o mpi_allgatherv_bug mpi_allgatherv_bug.o $(LIBS) && mpirun -np 1 ./mpi_allgatherv_bug || echo -DFORBID_F08)
+PROBES := $(PROBES) $(shell $(F90) $(CPPFLAGS) $(PROBES) $(F90FLAGS) ../compilers/tests/mpi_f08.F90 2> /dev/null && echo -DMPIF08 || echo -DNO_MPIF08_AVAILABLE)
+PROBES := $(PROBES) $(shell $(F90) $(CPPFLAGS) $(PROBES) $(F90FLAGS) ../compilers/tests/mpi.F90 2> /dev/null || echo -DNO_ALL_MPI_FUNCTIONS_AVAILABLE)
+PROBES := $(PROBES) $(shell $(F90) $(CPPFLAGS) $(PROBES) $(F90FLAGS) ../compilers/tests/F2018.F90 2> /dev/null || echo -DNO_F2018)
+ifndef CHECK_MAGIC
+$(shell $(RM) -f .setup.probes.*; $(ECHO) $(PROBES) > $(PROBES_CACHE))
+endif
+else
+PROBES := $(shell cat $(PROBES_CACHE))
+endif
+CPPFLAGS := $(CPPFLAGS) $(PROBES)
 
 all: env.dat print_setup $(PROG)
 
@@ -79,6 +101,9 @@ check_mpi:
 \t@$(F90) $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/mpi_f08.F90
 \t@$(F90) $(CPPFLAGS) $(F90FLAGS) ../compilers/tests/mpi.F90
 
+probes_key:
+\t@$(ECHO) $(PROBES_KEY) $(PROBES)
+
 $(PROG): $(OBJS) check_mpi
 ifeq ("$(SILENT)","1")
 \t@$(ECHO) $(PNAME)FC = $(F90) $(CPPFLAGS) $(F90FLAGS) -c
@@ -221,6 +246,431 @@ def get_stdout(cmd):
         return process.communicate()[0]
 
 
+def write_if_changed(fname, text):
+    # keep the timestamp of unchanged files, so that make does not consider them new
+    try:
+        if (open(fname, 'r').read() == text):
+            return False
+    except IOError:
+        pass
+    f = open(fname, 'w')
+    f.write(text)
+    f.close()
+    return True
+
+
+def remove_files(objdir, names):
+    for f in names:
+        if (os.path.lexists(objdir + '/' + f)):
+            os.remove(objdir + '/' + f)
+
+
+def update_links(objdir, sources, hard_copy, keep, old_sources):
+    # make objdir contain exactly the given {name: source} links (or copies) and the links to keep,
+    # return names that appeared, changed or vanished
+    changed = []
+    for f in os.listdir(objdir):
+        if ((os.path.islink(objdir + '/' + f) or f in old_sources) and f not in sources and f not in keep):
+            os.remove(objdir + '/' + f)
+            changed.append(f)
+    for f in sources:
+        dst = objdir + '/' + f
+        if (hard_copy):
+            if (os.path.isfile(dst) and not os.path.islink(dst) and filecmp.cmp(sources[f], dst, shallow=False)):
+                continue
+            if (os.path.lexists(dst)):
+                os.remove(dst)
+            shutil.copy(sources[f], dst)
+        else:
+            if (os.path.islink(dst) and os.readlink(dst) == '../' + sources[f]):
+                continue
+            if (os.path.lexists(dst)):
+                os.remove(dst)
+            os.symlink('../' + sources[f], dst)
+        changed.append(f)
+    return changed
+
+
+def cpp_scan(cmd):
+    # names of used and defined modules in a preprocessed file and whether cpp succeeded
+    nul_f = open(os.devnull, 'w')
+    process = sp.Popen([cmd], stdout=sp.PIPE, shell="/bin/bash", stderr=nul_f)
+    nul_f.close()
+    out = process.communicate()[0]
+    if sys.version_info >= (3, 0, 0):
+        out = out.decode('utf-8')
+    luse = []
+    lmod = []
+    for line in out.split('\n'):
+        if have_use(line):
+            luse.append(line.split()[1].rstrip(","))
+        if have_mod(line):
+            lmod.append(line.split()[1])
+    return luse, lmod, (process.returncode == 0 and len(out.strip()) > 0)
+
+
+def cpp_scan_all(cpp_cmd, f90list, headers, use_cache):
+    # Run cpp_scan on all files in parallel, reusing results of previous setups for unchanged files, headers and flags.
+    # Each cpp command (i.e. problem and flags) has its own cache file, which keeps only the results of the last setup,
+    # so setups of different problems run in parallel do not overwrite each other's results.
+    cache = {}
+    cache_file = cpp_cache_dir + '/' + hashlib.sha1(cpp_cmd.encode()).hexdigest()
+    if (use_cache and pickle_avail and os.path.isfile(cache_file)):
+        try:
+            output = open(cache_file, 'rb')
+            cache = pickle.load(output)
+            output.close()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            cache = {}
+    common = hashlib.sha1(cpp_cmd.encode())
+    for h in sorted(headers):
+        common.update(open(h, 'rb').read())
+    keys = []
+    for f in f90list:
+        key = common.copy()
+        key.update(open(f, 'rb').read())
+        keys.append(key.hexdigest())
+    todo = [i for i in range(len(f90list)) if keys[i] not in cache]
+    cmds = ["%s %s" % (cpp_cmd, f90list[i]) for i in todo]
+    if (mp and len(cmds) > 1):
+        pool = multiprocessing.pool.ThreadPool(multiprocessing.cpu_count())
+        scanned = pool.map(cpp_scan, cmds)
+        pool.close()
+    else:
+        scanned = [cpp_scan(c) for c in cmds]
+    result = dict((k, cache[k]) for k in keys if k in cache)
+    for i, res in zip(todo, scanned):
+        result[keys[i]] = res[:2]
+        if (res[2]):  # failed scans are repeated next time instead of reusing their missing dependencies
+            cache[keys[i]] = res[:2]
+    used = dict((k, cache[k]) for k in keys if k in cache)
+    if (use_cache and pickle_avail and (len(todo) > 0 or len(used) != len(cache))):  # new or stale entries
+        if (os.path.isfile(cpp_cache_dir)):  # single cache file of older setups
+            os.remove(cpp_cache_dir)
+        os.makedirs(cpp_cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=cpp_cache_dir)
+        output = os.fdopen(fd, 'wb')
+        pickle.dump(used, output, -1)
+        output.close()
+        os.replace(tmp, cache_file)
+    return [result[k] for k in keys], len(f90list) - len(todo)
+
+
+def tarjan_scc(graph):
+    # Strongly connected components of a graph given as {node: set of successors} (iterative Tarjan algorithm).
+    # Components come in topological order of the reversed graph: successors (module dependencies) first.
+    index = {}
+    low = {}
+    stack = []
+    onstack = set()
+    sccs = []
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        onstack.add(root)
+        work = [(root, iter(sorted(graph[root])))]
+        while work:
+            v, succ = work[-1]
+            for w in succ:
+                if w not in index:
+                    index[w] = low[w] = len(index)
+                    stack.append(w)
+                    onstack.add(w)
+                    work.append((w, iter(sorted(graph[w]))))
+                    break
+                elif w in onstack:
+                    low[v] = min(low[v], index[w])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[v])
+                if low[v] == index[v]:
+                    scc = []
+                    while True:
+                        w = stack.pop()
+                        onstack.discard(w)
+                        scc.append(w)
+                        if w == v:
+                            break
+                    sccs.append(scc)
+    return sccs
+
+
+def graph_reach(graph, sccs):
+    # bit of each node, its component number and bitsets of nodes reachable from each component
+    # (members of a component are reachable from it only when it is a cycle)
+    bit = {}
+    comp = {}
+    for i, c in enumerate(sccs):
+        for v in c:
+            bit[v] = 1 << len(bit)
+            comp[v] = i
+    reach = []
+    for i, c in enumerate(sccs):
+        r = 0
+        for v in c:
+            for w in graph[v]:
+                if comp[w] != i:
+                    r |= bit[w] | reach[comp[w]]
+        if len(c) > 1 or c[0] in graph[c[0]]:
+            for v in c:
+                r |= bit[v]
+        reach.append(r)
+    return bit, comp, reach
+
+
+def transitive_reduction(graph, sccs):
+    # Drop dependencies that are implied by other ones. Dependencies within cycles are kept, as well as all
+    # dependencies on members of a cycle that is not reached through another component.
+    bit, comp, reach = graph_reach(graph, sccs)
+    reduced = {}
+    for v in graph:
+        reduced[v] = set()
+        for w in graph[v]:
+            implied = False
+            if comp[w] != comp[v]:
+                for w2 in graph[v]:
+                    if comp[w2] != comp[w] and comp[w2] != comp[v] and bit[w] & reach[comp[w2]]:
+                        implied = True
+                        break
+            if not implied:
+                reduced[v].add(w)
+    return reduced
+
+
+def critical_path(graph, sccs, weight=None):
+    # The longest chain of dependencies: its total weight (number of files by default) and the files from the bottom.
+    # A cycle counts as a single link with the weights of its members summed up.
+    comp = {}
+    for i, c in enumerate(sccs):
+        for v in c:
+            comp[v] = i
+    length = []
+    below = []
+    for i, c in enumerate(sccs):
+        best, nxt = 0., None
+        for v in c:
+            for w in graph[v]:
+                if comp[w] != i and length[comp[w]] > best:
+                    best, nxt = length[comp[w]], comp[w]
+        length.append(best + sum(1. if weight is None else weight.get(v, 1.) for v in c))
+        below.append(nxt)
+    if len(sccs) == 0:
+        return 0., []
+    i = max(range(len(sccs)), key=lambda j: length[j])
+    top = length[i]
+    path = []
+    while i is not None:
+        path.append("+".join(sorted(sccs[i])))
+        i = below[i]
+    return top, path[::-1]
+
+
+def load_timings():
+    # {compiler config: {"scale": compile time per line, "files": {file: compile time}}} recorded in previous builds
+    if (pickle_avail and os.path.isfile(timings_file)):
+        try:
+            output = open(timings_file, 'rb')
+            t = pickle.load(output)
+            output.close()
+            return t
+        except (IOError, EOFError, pickle.UnpicklingError):
+            pass
+    return {}
+
+
+def save_timings(timings):
+    if (pickle_avail):
+        fd, tmp = tempfile.mkstemp(dir='.', prefix=timings_file)
+        output = os.fdopen(fd, 'wb')
+        pickle.dump(timings, output, -1)
+        output.close()
+        os.replace(tmp, timings_file)
+
+
+def read_build_times(fname):
+    # {file: (start, end)} of the latest successful compilation of each file recorded by bin/compile_timer
+    times = {}
+    try:
+        for line in open(fname):
+            f, t0, t1, rc = line.split()
+            if (rc == "0"):
+                times[remove_suf(strip_leading_path([f]))[0]] = (float(t0), float(t1))
+    except IOError:
+        pass
+    return times
+
+
+def estimate_compile_times(files, timings):
+    # recorded compile times, or estimates from the number of lines scaled by previous builds
+    weight = {}
+    for f in files:
+        name = remove_suf(strip_leading_path([f]))[0]
+        if name in timings.get("files", {}):
+            weight[name] = timings["files"][name]
+        else:
+            weight[name] = timings.get("scale", default_scale) * sum(1 for line in open(f, 'rb'))
+    for f in ("version", "os_detect"):
+        weight.setdefault(f, timings.get("files", {}).get(f, timings.get("scale", default_scale) * 10))
+    return weight
+
+
+def build_priority(graph, sccs, weight):
+    # compile time of the longest chain of files from each file up to the ones nothing depends on
+    comp = {}
+    for i, c in enumerate(sccs):
+        for v in c:
+            comp[v] = i
+    users = dict((v, []) for v in graph)
+    for v in graph:
+        for w in graph[v]:
+            if comp[w] != comp[v]:
+                users[w].append(v)
+    priority = {}
+    for c in reversed(sccs):
+        top = max([priority[u] for v in c for u in users[v]] + [0.])
+        for v in c:
+            priority[v] = top + sum(weight.get(x, 0.) for x in c)
+    return priority
+
+
+def predict_build_time(graph, sccs, weight, priority, jobs):
+    # simulate make -j jobs starting the ready files with the highest priority first
+    comp = {}
+    for i, c in enumerate(sccs):
+        for v in c:
+            comp[v] = i
+    waiting = dict((v, len([w for w in graph[v] if comp[w] != comp[v]])) for v in graph)
+    users = dict((v, []) for v in graph)
+    for v in graph:
+        for w in graph[v]:
+            if comp[w] != comp[v]:
+                users[w].append(v)
+    ready = [v for v in graph if waiting[v] == 0]
+    running = []
+    now = 0.
+    while ready or running:
+        ready.sort(key=lambda v: -priority[v])
+        while ready and len(running) < jobs:
+            v = ready.pop(0)
+            running.append((now + weight.get(v, 0.), v))
+        running.sort()
+        now, v = running.pop(0)
+        for u in users[v]:
+            waiting[u] -= 1
+            if waiting[u] == 0:
+                ready.append(u)
+    return now
+
+
+def fan_in(graph):
+    # how many files depend directly on each file
+    cnt = dict((v, 0) for v in graph)
+    for v in graph:
+        for w in graph[v]:
+            cnt[w] += 1
+    return cnt
+
+
+def object_keys(graph, sccs, srcs, incl, sources, salt, generated):
+    # Content hashes of objects: compiler settings and effective defines (salt), the source, included headers and
+    # keys of all modules it uses. None marks objects that cannot be shared (circular dependencies, sources generated
+    # by the Makefile other than those that depend only on the files they use).
+    # piernik.def is represented by the defines in salt, so problems that differ only in comments share objects.
+    keys = {}
+    for c in sccs:  # dependencies come first
+        for f in c:
+            keys[f] = None
+            if (len(c) > 1 or f in graph[f] or (srcs.get(f) not in sources and f not in generated) or any(keys[d] is None for d in graph[f])):
+                continue
+            key = hashlib.sha1(salt.encode())
+            key.update(f.encode())
+            if (f not in generated):
+                key.update(open(sources[srcs[f]], 'rb').read())
+            for h in incl[f]:
+                if (h != "piernik.def" and h in sources):
+                    key.update(open(sources[h], 'rb').read())
+            for d in sorted(graph[f]):
+                key.update(keys[d].encode())
+            keys[f] = key.hexdigest()
+    return keys
+
+
+def fetch_objects(objdir, graph, sccs, keys):
+    # Copy cached objects (with their module files and generated sources) into objdir, when all their dependencies are cached as well.
+    # Copies get increasing modification times in dependency order, so make considers them up to date.
+    # Objects are not linked, because a rebuild in one object directory would overwrite the cached file.
+    hits = set()
+    t = time.time_ns()
+    for c in sccs:
+        for f in c:
+            if (keys[f] is None or not graph[f] <= hits or not os.path.isdir(obj_cache_dir + '/' + keys[f])):
+                continue
+            for n in sorted(os.listdir(obj_cache_dir + '/' + keys[f])):
+                shutil.copy(obj_cache_dir + '/' + keys[f] + '/' + n, objdir)
+                t += 1000
+                os.utime(objdir + '/' + n, ns=(t, t))
+            hits.add(f)
+    return hits
+
+
+def store_objects(objdir, keys, hits, module, generated):
+    # Put newly compiled objects, their module files and generated sources into the cache, return the number of stored objects
+    stored = 0
+    for f in sorted(keys):
+        if (keys[f] is None or f in hits or os.path.isdir(obj_cache_dir + '/' + keys[f])):
+            continue
+        names = [f + ".o"] + ([f + ".F90"] if f in generated else [])
+        for m in sorted(module):
+            if (module[m] == f):
+                names.append(m.lower() + ".mod" if os.path.isfile(objdir + '/' + m.lower() + ".mod") else m + ".mod")
+        if (not all(os.path.isfile(objdir + '/' + n) for n in names)):
+            continue
+        if (not os.path.isdir(obj_cache_dir)):
+            os.mkdir(obj_cache_dir)
+        tmp = tempfile.mkdtemp(dir=obj_cache_dir)
+        for n in names:
+            shutil.copy2(objdir + '/' + n, tmp)
+        try:
+            os.rename(tmp, obj_cache_dir + '/' + keys[f])
+            stored += 1
+        except OSError:  # stored meanwhile by another setup
+            shutil.rmtree(tmp)
+    return stored
+
+
+def get_cppflags(options):
+    # '-d DEF1,DEF2 -d DEF3' -> ' -DDEF1 -DDEF2 -DDEF3'
+    cppflags = ""
+    if (options.cppflags):
+        for flag_grp in options.cppflags:
+            for flag in flag_grp.split(","):
+                if (len(flag) > 0):
+                    cppflags += ' -D' + flag
+    return cppflags
+
+
+def find_piernikdef(probdir):
+    # piernik.def of a problem, possibly inherited from a parent directory
+    pdir = os.path.dirname(probdir)  # strip trailing '/'
+    while (os.path.basename(pdir) not in ("..", "problems")):
+        if (os.path.isfile(pdir + "/piernik.def")):
+            return pdir + "/piernik.def"
+        pdir = os.path.dirname(pdir)
+    return ""
+
+
+def cpp_defines(cppflags, defdir):
+    # symbols defined by piernik.h with given cppflags and piernik.def from defdir
+    foo_fd, foo_path = tempfile.mkstemp(suffix=".f90", dir='.')
+    cmd = "echo '#include \"%spiernik.h\"' > \"%s\"" % ('src/base/', foo_path)
+    cmd += " && cpp %s -dM -I%s \"%s\" && rm \"%s\"" % (
+        cppflags, defdir, foo_path, foo_path)
+    return cmd, get_stdout(cmd).rstrip().split("\n")
+
+
 def list_info(dir, indent):
     tab = []
     name = " " * (2 * indent) + os.path.basename(dir)
@@ -282,6 +732,53 @@ def setup_piernik(data=None):
     if (options.show_units or options.show_problems):
         sys.exit()
 
+    if (options.batch):
+        setup_batch(options, args, all_args, sys_args)
+    else:
+        setup_problem(options, args, all_args, sys_args)
+
+
+def setup_batch(options, args, all_args, sys_args):
+    # Set up each problem in its own obj_POSTFIX<problem> directory. Problems with the same effective defines
+    # are set up one after another and reuse objects compiled for the previous ones (see object_keys()).
+    if (len(args) < 1):
+        sys.stderr.write('\033[91m' + "\nNo problem_name has been provided" + '\033[0m' + "\n")
+        exit()
+
+    groups = {}
+    for p in args:
+        if (not os.path.isdir('problems/' + p)):
+            print("\033[91mCannot find problem directory '%s'." % ('problems/' + p + '/') + '\033[0m')
+            sys.exit()
+        cmd, defines = cpp_defines(get_cppflags(options), os.path.dirname(find_piernikdef('problems/' + p + '/')))
+        groups.setdefault("\n".join(sorted(filter(cpp_junk.match, defines))), []).append(p)
+    print("Setting up %d problems with %d distinct sets of defines" % (len(args), len(groups)))
+
+    for g in groups.values():
+        for p in g:
+            postfix = options.objdir + p.replace("/", "___")
+            opts = copy.copy(options)
+            opts.batch = False
+            opts.objdir = postfix
+            setup_problem(opts, [p], [p] + batch_args(all_args, args) + ["-o", postfix],
+                          sys_args[:1] + [p] + batch_args(sys_args[1:], args) + ["-o", postfix], True)
+
+
+def batch_args(argv, problems):
+    # arguments of a batch setup call without --batch, problem names and the obj directory postfix
+    out = []
+    skip = False
+    for a in argv:
+        if (skip):
+            skip = False
+        elif (a in ("-o", "--obj")):
+            skip = True
+        elif (not (a in problems or a == "--batch" or a.startswith("--obj=") or re.match(r"-o.", a))):
+            out.append(a)
+    return out
+
+
+def setup_problem(options, args, all_args, sys_args, obj_cache=False):
     if (len(args) < 1):
         sys.stderr.write('\033[91m' + "\nNo problem_name has been provided" + '\033[0m' + "\n")
         exit()
@@ -297,12 +794,7 @@ def setup_piernik(data=None):
         sys.exit()
 
     # parse cppflags
-    cppflags = ""
-    if (options.cppflags):
-        for flag_grp in options.cppflags:
-            for flag in flag_grp.split(","):
-                if (len(flag) > 0):
-                    cppflags += ' -D' + flag
+    cppflags = get_cppflags(options)
 
     # parse compiler
     if (not re.search(r'\.in$', options.compiler)):
@@ -318,9 +810,16 @@ def setup_piernik(data=None):
     else:
         rundir += '/'
 
+    old_state = None
     if (os.path.isdir(objdir)):
-        shutil.rmtree(objdir)
-    os.mkdir(objdir)
+        if (options.incremental and pickle_avail and os.path.isfile(objdir + '/.setup.deps')):
+            output = open(objdir + '/.setup.deps', 'rb')
+            old_state = pickle.load(output)
+            output.close()
+        else:
+            shutil.rmtree(objdir)
+    if (not os.path.isdir(objdir)):
+        os.mkdir(objdir)
 
     print("Using compiler settings from \033[93m" + compiler + "\033[0m")
     sc = open(objdir + "/.setup.call", "w")
@@ -381,11 +880,7 @@ def setup_piernik(data=None):
     if (req_missing):
         sys.exit()
 
-    foo_fd, foo_path = tempfile.mkstemp(suffix=".f90", dir='.')
-    cmd = "echo '#include \"%spiernik.h\"' > \"%s\"" % ('src/base/', foo_path)
-    cmd += " && cpp %s -dM -I%s \"%s\" && rm \"%s\"" % (
-        cppflags, os.path.dirname(piernikdef), foo_path, foo_path)
-    defines = get_stdout(cmd).rstrip().split("\n")
+    cmd, defines = cpp_defines(cppflags, os.path.dirname(piernikdef))
     if (options.verbose):
         print(cmd)
         print("Defined symbols:")
@@ -437,7 +932,6 @@ def setup_piernik(data=None):
         keys_logic1 = False
         keys_logic2 = False
         keys = []
-        luse = []
         linc = []
         for line in open(f):       # Scan original files
             if test(line):
@@ -458,19 +952,20 @@ def setup_piernik(data=None):
                                       keys[2] in our_defs)))
 
         if (keys_logic1 or keys_logic2):
-            # workaround the fact that we're using cpp and some of use clauses may depend on __INTEL_COMPILER
-            cmd = "cpp %s -I%s -I%s -I%s %s" % (cppflags + " -D__INTEL_COMPILER", probdir, 'src/base', os.path.dirname(piernikdef), f)
-            # Scan preprocessed files
-            lines = get_stdout(cmd).split('\n')
-            for line in lines:
-                if have_use(line):
-                    luse.append(line.split()[1].rstrip(","))
-                if have_mod(line):
-                    module.setdefault(line.split()[1],
-                                      remove_suf(strip_leading_path([f]))[0])
             files.append(f)
-            uses.append(list(set(luse)))
-            incl.append(list(set(linc)))
+            incl.append(sorted(set(linc)))
+
+    # workaround the fact that we're using cpp and some of use clauses may depend on __INTEL_COMPILER
+    cpp_cmd = "cpp %s -I%s -I%s -I%s" % (cppflags + " -D__INTEL_COMPILER", probdir, 'src/base', os.path.dirname(piernikdef))
+    # Scan preprocessed files
+    headers = [f for f in allfiles if is_header.search(f) or os.path.basename(f) == "piernik.def"]
+    scanned, n_cached = cpp_scan_all(cpp_cmd, files[1:], headers, not options.no_cpp_cache)
+    if (options.verbose):
+        print("Preprocessed %d files, %d scans reused from %s" % (len(scanned) - n_cached, n_cached, cpp_cache_dir))
+    for f, (luse, lmod) in zip(files[1:], scanned):
+        for mod in lmod:
+            module.setdefault(mod, remove_suf(strip_leading_path([f]))[0])
+        uses.append(sorted(set(luse)))
 
     # for i in iter(module):
     #   if module[i] != i:
@@ -478,34 +973,37 @@ def setup_piernik(data=None):
 
     allfiles.extend(files)
 
+    sources = {}
     for f in allfiles:
-        if (options.hard_copy):
-            shutil.copy(f, objdir)
-            # Perhaps we should check for overwriting duplicates here too
-        else:
-            try:
-                os.symlink('../' + f,
-                           objdir + '/' + strip_leading_path([f])[0])
-            except FileExistsError:
-                print("Possible duplicate link or a name clash :", f)
-                raise
+        if (strip_leading_path([f])[0] in sources and not options.hard_copy):
+            print("Possible duplicate link or a name clash :", f)
+            raise FileExistsError(f)
+        sources[strip_leading_path([f])[0]] = f
+    if (options.time_build and options.hard_copy):
+        sources['compile_timer'] = 'bin/compile_timer'
+    changed_links = update_links(objdir, sources, options.hard_copy, ['problem.par'] if options.param != 'problem.par' else [],
+                                 old_state["sources"] if old_state is not None else [])
 
     if (options.hard_copy):
         otdir = objdir + "/tests/"
-        os.mkdir(otdir)
+        if (not os.path.isdir(otdir)):
+            os.mkdir(otdir)
         ctdir = "compilers/tests/"
         for f in os.listdir(ctdir):
-            shutil.copy(ctdir + f, otdir)
+            if (not (os.path.isfile(otdir + f) and filecmp.cmp(ctdir + f, otdir + f, shallow=False))):
+                shutil.copy(ctdir + f, otdir)
 
     if (options.param != 'problem.par'):
-        os.symlink(options.param, objdir + '/' + 'problem.par')
+        if (os.path.lexists(objdir + '/' + 'problem.par') and not (os.path.islink(objdir + '/' + 'problem.par') and os.readlink(objdir + '/' + 'problem.par') == options.param)):
+            os.remove(objdir + '/' + 'problem.par')
+        if (not os.path.lexists(objdir + '/' + 'problem.par')):
+            os.symlink(options.param, objdir + '/' + 'problem.par')
 
     makefile_head = open('compilers/' + compiler, 'r').readlines()
     try:
         makefile_problem = open(probdir + "Makefile.in", 'r').readlines()  # BEWARE: Makefile.in is not inherited from the parent problem yet
     except (IOError):
         makefile_problem = ""
-    m = open(objdir + '/Makefile', 'w')
 
     stripped_files = strip_leading_path(files)
     stripped_files_v = strip_leading_path(files)
@@ -525,30 +1023,74 @@ def setup_piernik(data=None):
 
     files_to_build = remove_suf(stripped_files)
 
-    if options.piernik_debug:
-        m.write("PIERNIK_DEBUG=1\n")
-    for f in makefile_head:
-        m.write(f)
-    for f in makefile_problem:
-        m.write(f)
-    m.write(pretty_format_suf("SRCS_V = \\", stripped_files_v, '', columns))
-    m.write("SRCS = $(SRCS_V) version.F90\n")
-    m.write(pretty_format_suf("OBJS = \\", files_to_build, '.o', columns))
-    m.write("\nCPPFLAGS += %s\n" % cppflags)
+    # The following code generates simplified module dependency graph data.
+    # The simplification is done by removing dependencies of a given element
+    # that are implied by its other dependencies (transitive reduction).
+    # This is the minimum set of dependencies that are necessary for the make
+    # process.
+
+    # Collect the data in dictionary of dependence sets
+    dep_s = dict()
+    for i in range(0, len(files_to_build)):
+        dep_s[files_to_build[i]] = set()
+        for u in uses[i]:
+            if u in module:
+                if module[u] + '.F90' in stripped_files:
+                    dep_s[files_to_build[i]].add(module[u])
+
+    sccs = tarjan_scc(dep_s)
+    for c in sccs:
+        if (len(c) > 1 or c[0] in dep_s[c[0]]):
+            print('\033[91m' + "Circular dependencies between: " + " ".join(sorted(c)) + '\033[0m')
+    dep = transitive_reduction(dep_s, sccs)
+    if (options.verbose):
+        length, path = critical_path(dep_s, sccs)
+        fi = fan_in(dep_s)
+        print("Dependency graph: %d files, %d dependencies, %d after transitive reduction" %
+              (len(dep_s), sum(len(dep_s[m]) for m in dep_s), sum(len(dep[m]) for m in dep)))
+        print("Critical path (%d files): %s" % (length, " -> ".join(path)))
+        print("Most used: " + ", ".join("%s (%d)" % (m, fi[m]) for m in sorted(fi, key=lambda m: (-fi[m], m))[:10]))
+
+    # Start the longest chains of dependent files first: make follows the order of $(OBJS) when it looks for jobs
+    timings_key = compiler + (" debug" if options.piernik_debug else "")
+    timings = load_timings().get(timings_key, {})
+    weight = estimate_compile_times(files, timings)
+    priority = build_priority(dep_s, sccs, weight)
+    objs = sorted(files_to_build, key=lambda f: -priority[f])
+    jobs = multiprocessing.cpu_count() if mp else 1
+    predicted = predict_build_time(dep_s, sccs, weight, priority, jobs)
+    if (options.verbose):
+        print("Predicted build time: %.1f s on %d cores, %.1f s on the critical path, %.1f s in total" %
+              (predicted, jobs, max(priority.values()), sum(weight.values())))
+
+    # The Makefile is assembled from parts that affect compilation of all objects (mk_head, mk_flags),
+    # lists of files, the setup call recorded in env.dat and dependency lines of each object (mk_deps)
+    mk_head = "PIERNIK_DEBUG=1\n" if options.piernik_debug else ""
+    mk_head += "".join(makefile_head) + "".join(makefile_problem)
+    mk_files = pretty_format_suf("SRCS_V = \\", stripped_files_v, '', columns)
+    mk_files += "SRCS = $(SRCS_V) version.F90\n"
+    mk_files += pretty_format_suf("OBJS = \\", objs, '.o', columns)
+    mk_flags = "\nCPPFLAGS += %s\n" % cppflags
     if (isinstance(options.f90flags, str)):
-        m.write("\nF90FLAGS += %s\n" % options.f90flags)
+        mk_flags += "\nF90FLAGS += %s\n" % options.f90flags
     if ("SHEAR" in our_defs or "MULTIGRID" in our_defs):
         if ("NO_FFT" not in our_defs):
-            m.write("LIBS += $(shell pkg-config --libs fftw3)\n")
-        m.write("CPPFLAGS += $(shell pkg-config --libs fftw3 2> /dev/null || echo '-DNO_FFT')\n")
+            mk_flags += "LIBS += $(shell pkg-config --libs fftw3)\n"
+        mk_flags += "CPPFLAGS += $(shell pkg-config --libs fftw3 2> /dev/null || echo '-DNO_FFT')\n"
     if ("PIERNIK_OPENCL" in our_defs):
-        m.write("LIBS += $(shell pkg-config --libs fortrancl)\n")
-        m.write("F90FLAGS += $(shell pkg-config --cflags fortrancl)\n")
-
-    m.write("SILENT = %d\n\n" % (1 if options.laconic else 0))
-    m.write(head_block1.replace("./compilers", "") if options.hard_copy else head_block1)
-    m.write("\t@( $(ECHO) \"%s\"; \\" % ("./setup " + " ".join(all_args)))
-    m.write(head_block2)
+        mk_flags += "LIBS += $(shell pkg-config --libs fortrancl)\n"
+        mk_flags += "F90FLAGS += $(shell pkg-config --cflags fortrancl)\n"
+
+    if (options.time_build):
+        mk_flags += "TIME_FC = %s %s\n" % ("./compile_timer" if options.hard_copy else "../bin/compile_timer", build_times_file)
+    mk_flags += "SILENT = %d\n\n" % (1 if options.laconic else 0)
+    mk_flags += head_block1.replace("./compilers", "") if options.hard_copy else head_block1
+    mk_call = "\t@( $(ECHO) \"%s\"; \\" % ("./setup " + " ".join(all_args))
+    mk_flags2 = head_block2
+    if (options.time_build):
+        mk_flags2 = mk_flags2.replace("\t$(F90) $(CPPFLAGS) $(F90FLAGS) -c $<", "\t$(TIME_FC) $(F90) $(CPPFLAGS) $(F90FLAGS) -c $<")
+        mk_flags2 = mk_flags2.replace("\t$(CC) $(CPPFLAGS) $(CFLAGS) -c $<", "\t$(TIME_FC) $(CC) $(CPPFLAGS) $(CFLAGS) -c $<")
+    mk_deps = {}
 
     for i in range(0, len(files_to_build)):
         deps = files_to_build[i] + ".o: " + stripped_files[i] + " "
@@ -568,54 +1110,40 @@ def setup_piernik(data=None):
                 if j not in known_external_modules:
                     print("Warning: module " + j + " from file " +
                           stripped_files[i] + " not found!")
-        m.write(pretty_format(deps, d.split(), columns))
-    m.close()
-
-    # The following code generates simplified module dependency graph data.
-    # The simplification is done by removing dependencies of a given element
-    # that are common with dependencies of its parent.
-    # This is the minimum set of dependencies that are necessary for the make
-    # process.
-    # This implementation probably may fail on circular dependencies.
-
-    # Collect the data in dictionary of dependence sets
-    dep = dict()
-    for i in range(0, len(files_to_build)):
-        dep[files_to_build[i]] = set()
-        for u in uses[i]:
-            if u in module:
-                if module[u] + '.F90' in stripped_files:
-                    dep[files_to_build[i]].add(module[u])
-
-    # save a copy
-    dep_s = dict()
-    for m in dep:
-        dep_s[m] = set(dep[m])
-
-    # construct set of parent dependences
-    for m in dep_s:
-        dep[m] = set()
-        for d in dep_s[m]:
-            dep[m] = dep[m].union(dep_s[d])
-
-    # iterate, until all parent dependences are propagated
-    # note that cheaper algorithms should exist. We will look for them when
-    # we reach few hundreds of modules :-P
-    dep_i = dict()
-    while True:
-        cnt = 0
-        for m in dep:
-            dep_i[m] = set(dep[m])
-        for m in dep:
-            for d in dep[m].union(dep_s[m]):
-                for pd in dep[m].union(dep_s[d]):
-                    if pd not in dep_i[m]:
-                        dep_i[m].add(pd)
-                        cnt = cnt + 1
-        for m in dep_i:
-            dep[m] = dep[m].union(dep_i[m])
-        if (cnt == 0):
-            break
+        mk_deps[files_to_build[i]] = pretty_format(deps, d.split(), columns)
+
+    # Remove only the objects that have to be rebuilt. Changes in compiler settings or flags affect everything.
+    new_state = {"build": mk_head + mk_flags + mk_flags2, "call": mk_call, "deps": mk_deps, "sources": list(sources)}
+    if (old_state is not None):
+        if (old_state["build"] != new_state["build"]):
+            print("Compiler settings changed, rebuilding everything in '%s'" % objdir)
+            remove_files(objdir, [f for f in os.listdir(objdir) if f.endswith((".o", ".mod"))] + ["piernik"])
+        else:
+            stale = set(remove_suf(changed_links))
+            for o in old_state["deps"]:
+                if (o not in mk_deps or old_state["deps"][o] != mk_deps[o]):
+                    stale.add(o)
+            remove_files(objdir, [o + ".o" for o in stale])
+            if (set(old_state["deps"]) != set(mk_deps)):
+                remove_files(objdir, ["piernik"])
+            if (options.verbose):
+                print("Objects to be rebuilt: " + " ".join(sorted(stale)))
+        if (old_state["call"] != mk_call):
+            remove_files(objdir, ["env.dat"])
+    write_if_changed(objdir + '/Makefile', mk_head + mk_files + mk_flags + mk_call + mk_flags2 + "".join(mk_deps.values()))
+    if (pickle_avail):
+        output = open(objdir + '/.setup.deps', 'wb')
+        pickle.dump(new_state, output)
+        output.close()
+
+    hits = set()
+    if (obj_cache):
+        # results of compiler probes identify the toolchain, the rest of the salt is common to problems with the same defines
+        generated = ["os_detect"]  # version.F90 contains env.dat, which differs between problems
+        salt = new_state["build"] + get_stdout("make -s -C %s probes_key" % objdir) + "\n".join(sorted(filter(cpp_junk.match, defines)))
+        obj_keys = object_keys(dep_s, sccs, dict(zip(files_to_build, stripped_files)), dict(zip(files_to_build, incl)), sources, salt, generated)
+        hits = fetch_objects(objdir, dep_s, sccs, obj_keys)
+        print("Reused %d of %d objects from %s" % (len(hits), len(files_to_build), obj_cache_dir))
 
     # assign color to boxes according to their location in source tree
     # some more colors that can be used: tan, lavender, beige, mauve
@@ -635,22 +1163,22 @@ def setup_piernik(data=None):
         dirs[key] = set(dirs[key])
 
     # write the connectivity file
-    dd = open(objdir + '/dep.dot', "w")
-    dd.write("digraph piernik {\n")
-    dd.write("\t label=\"Dependency graph for the \'" + args[0] + "\' problem\"\n")
+    dd = []
+    dd.append("digraph piernik {\n")
+    dd.append("\t label=\"Dependency graph for the \'" + args[0] + "\' problem\"\n")
     for m in dep:
-        for mod in dep_s[m].difference(dep[m]):
+        for mod in sorted(dep[m]):
             try:
                 longest_key = max(dirs[mod].intersection(set(colors.keys())))
-                dd.write('\t "%s" [color="%s"];\n' % (mod, colors[longest_key]))
+                dd.append('\t "%s" [color="%s"];\n' % (mod, colors[longest_key]))
                 del dirs[mod]  # prevent duplicates
             except KeyError:
                 pass
-            dd.write('\t "' + mod + '" -> "' + m + '"\n')
-    dd.write('\t subgraph legend {\n\t\t label = "Legend"\n')
+            dd.append('\t "' + mod + '" -> "' + m + '"\n')
+    dd.append('\t subgraph legend {\n\t\t label = "Legend"\n')
     roots = []
     for k in colors:
-        dd.write('\t\t "%s" [color="%s"]\n' % (k, colors[k]))
+        dd.append('\t\t "%s" [color="%s"]\n' % (k, colors[k]))
         llen = 0
         ldir = ""
         for kk in colors:
@@ -660,15 +1188,15 @@ def setup_piernik(data=None):
                         llen = len(kk)
                         ldir = kk
         if llen > 0:
-            dd.write('\t\t "%s" -> "%s"\n' % (ldir, k))
+            dd.append('\t\t "%s" -> "%s"\n' % (ldir, k))
         else:
             roots.append(k)
-    dd.write('\t }\n')
+    dd.append('\t }\n')
     for r in roots:
-        dd.write('\t {"piernik" -> "%s" [style = "invisible"; dir=none]}\n' % r)
+        dd.append('\t {"piernik" -> "%s" [style = "invisible"; dir=none]}\n' % r)
         # Formally we should calculate the bottom node, not assume it'll be just "piernik"
-    dd.write("}\n")
-    dd.close()
+    dd.append("}\n")
+    write_if_changed(objdir + '/dep.dot', "".join(dd))
 
     fatal_problem = False
 
@@ -677,8 +1205,25 @@ def setup_piernik(data=None):
         if (mp):
             makejobs = "-j%i" % multiprocessing.cpu_count()
         makecmd = "make %s -C %s" % (makejobs, objdir)
+        remove_files(objdir, [build_times_file])
+        t0 = time.time()
         if (sp.call([makecmd], shell=True) != 0):
             sys.exit('\033[91m' + "It appears that '%s' crashed. Cannot continue." % makecmd + '\033[0m')
+        actual = time.time() - t0
+        if (old_state is None and len(hits) == 0):  # complete builds only
+            print("Build took %.1f s (predicted %.1f s)" % (actual, predicted))
+            if (len(timings.get("files", {})) == 0):
+                timings["scale"] = timings.get("scale", default_scale) * actual / predicted
+        if (options.time_build):
+            times = read_build_times(objdir + "/" + build_times_file)
+            timings.setdefault("files", {}).update((f, times[f][1] - times[f][0]) for f in times)
+            print("Compile times of %d files recorded in %s, run 'python/build_profile.py %s' for a report" % (len(times), timings_file, objdir))
+        if (old_state is None or options.time_build):
+            all_timings = load_timings()
+            all_timings[timings_key] = timings
+            save_timings(all_timings)
+        if (obj_cache):
+            print("Stored %d objects in %s" % (store_objects(objdir, obj_keys, hits, module, generated), obj_cache_dir))
 
     try:
         os.makedirs(rundir)
@@ -840,6 +1385,22 @@ compilers directory.""", metavar="FILE")
                       default='', help="""Use obj_POSTFIX directory instead of obj/ and
 runs/<problem>_POSTFIX rather than runs/<problem> .""")
 
+    parser.add_option("--incremental", action="store_true", dest="incremental",
+                      default=False, help="""Keep the existing object directory and
+update only the links, Makefile and objects affected by changes.""")
+
+    parser.add_option("--nocppcache", action="store_true", dest="no_cpp_cache",
+                      default=False, help="Do not reuse nor store results of scanning source files with cpp in %s ." % cpp_cache_dir)
+
+    parser.add_option("--timebuild", action="store_true", dest="time_build",
+                      default=False, help="""Record compile time of each file (see
+bin/compile_timer and python/build_profile.py).""")
+
+    parser.add_option("--batch", action="store_true", dest="batch",
+                      default=False, help="""Set up all given problems in
+obj_POSTFIX<problem> directories. Objects that do not depend on differences between
+problems are compiled once and copied from %s (safe to remove).""" % obj_cache_dir)
+
     parser.add_option("-k", "--keeppar", action="store_true", dest="keep_par",
                       help="Do not override existing problem.par file with the default one.")
 
@@ -1,8 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import contextlib
 import h5py
+import io
 import matplotlib
+import matplotlib.animation as manimation
 import numpy as np
 import pylab as P
 from mpl_toolkits.axes_grid1 import AxesGrid
@@ -11,8 +14,11 @@ import plot_utils as pu
 import pvf_settings as ps
 import read_dataset as rd
 import time as timer
+import traceback
 # matplotlib.use('cairo')      # choose output format
 
+movies = {}
+
 
 def plot_axes(ax, ulen, l1, min1, max1, l2, min2, max2):
     ax.set_xlim(min1, max1)
@@ -23,7 +29,7 @@ def plot_axes(ax, ulen, l1, min1, max1, l2, min2, max2):
 
 
 def plot1d(refis, field, parts, equip1d, ncut, n1, n2):
-    smin, smax, zoom, ulen, sctype, umin, umax, linstyl, output, timep = equip1d
+    smin, smax, zoom, ulen, sctype, umin, umax, linstyl, output, timep, movie = equip1d
     fig1d = P.figure(ncut + 2, figsize=(10, 8))
     ax = fig1d.add_subplot(111)
     P.xlim(zoom[1][ncut], zoom[2][ncut])
@@ -79,15 +85,13 @@ def plot1d(refis, field, parts, equip1d, ncut, n1, n2):
     P.title(timep)
     P.tight_layout()
     P.draw()
-    out1d = output[0] + axis + '_' + output[1]
-    fig1d.savefig(out1d, facecolor=ps.f_facecolor)
-    print(out1d, "written to disk")
+    save_frame(fig1d, output, axis + '_', movie)
     P.clf()
 
 
 def draw_plotcomponent(ax, refis, field, parts, equip2d, ncut, n1, n2):
     smin, smax, zoom, ulen, sctype, scnorm, drawg, gcolor, center = equip2d
-    ag, ah = [], []
+    ims, ah = [], []
     if field[0] or drawg:
         if field[0]:
             vmin, vmax, symmin, cmap, autosc = field[1:-1]
@@ -98,12 +102,12 @@ def draw_plotcomponent(ax, refis, field, parts, equip2d, ncut, n1, n2):
                     if bxyz != []:
                         bplot = pu.scale_plotarray(bxyz[ncut], sctype, symmin)
                         if scnorm == '':
-                            ag = ax.imshow(bplot, origin="lower", extent=[ble[n1], bre[n1], ble[n2], bre[n2]], vmin=vmin, vmax=vmax, interpolation='nearest', cmap=cmap)
+                            ims.append(ax.imshow(bplot, origin="lower", extent=[ble[n1], bre[n1], ble[n2], bre[n2]], vmin=vmin, vmax=vmax, interpolation='nearest', cmap=cmap))
                         else:
                             if autosc:
-                                ag = ax.imshow(bplot, origin="lower", extent=[ble[n1], bre[n1], ble[n2], bre[n2]], norm=scnorm, interpolation='nearest', cmap=cmap)
+                                ims.append(ax.imshow(bplot, origin="lower", extent=[ble[n1], bre[n1], ble[n2], bre[n2]], norm=scnorm, interpolation='nearest', cmap=cmap))
                             else:
-                                ag = ax.imshow(bplot, origin="lower", extent=[ble[n1], bre[n1], ble[n2], bre[n2]], norm=scnorm, vmin=vmin, vmax=vmax, interpolation='nearest', cmap=cmap)
+                                ims.append(ax.imshow(bplot, origin="lower", extent=[ble[n1], bre[n1], ble[n2], bre[n2]], norm=scnorm, vmin=vmin, vmax=vmax, interpolation='nearest', cmap=cmap))
                     if drawg:
                         ax.plot([ble[n1], ble[n1], bre[n1], bre[n1], ble[n1]], [ble[n2], bre[n2], bre[n2], ble[n2], ble[n2]], '-', linewidth=ps.grid_linewidth, alpha=0.1 * float(level + 1), color=gcolor[level], zorder=4)
     if parts[0]:
@@ -118,12 +122,32 @@ def draw_plotcomponent(ax, refis, field, parts, equip2d, ncut, n1, n2):
         else:
             pn1, pn2, pmm = pxyz[n1], pxyz[n2], pm
         ax, ah = draw_particles(ax, pn1, pn2, pmm, nbins, [smin[n1], smax[n1], smin[n2], smax[n2]], field[0], pcolor, psize, pstype)
+    ax = center_axes(ax, ulen, zoom, center, n1, n2)
+    return ax, ims, ah
+
+
+def update_plotcomponent(ax, ims, refis, field, equip2d, ncut, n1, n2):
+    smin, smax, zoom, ulen, sctype, scnorm, drawg, gcolor, center = equip2d
+    if field[0]:
+        vmin, vmax, symmin, cmap, autosc = field[1:-1]
+        bxyzs = [bl[0][ncut] for blks in refis for bl in blks if bl[1][ncut] and bl[0] != []]
+        for ag, bxyz in zip(ims, bxyzs):
+            ag.set_data(pu.scale_plotarray(bxyz, sctype, symmin))
+            if scnorm != '' and autosc:
+                ag.norm.vmin, ag.norm.vmax = None, None
+                ag.autoscale_None()
+            else:
+                ag.set_clim(vmin, vmax)
+    return center_axes(ax, ulen, zoom, center, n1, n2)
+
+
+def center_axes(ax, ulen, zoom, center, n1, n2):
     ax = plot_axes(ax, ulen, "xyz"[n1], zoom[1][n1], zoom[2][n1], "xyz"[n2], zoom[1][n2], zoom[2][n2])
     ax.set_xticks([center[n1]], minor=True)
     ax.set_yticks([center[n2]], minor=True)
     ax.tick_params(axis='x', which='minor', color=ps.centertick_color, bottom='on', top='on', width=ps.centertick_width, length=ps.centertick_length)
     ax.tick_params(axis='y', which='minor', color=ps.centertick_color, left='on', right='on', width=ps.centertick_width, length=ps.centertick_length)
-    return ax, ag, ah
+    return ax
 
 
 def draw_particles(ax, p1, p2, pm, nbins, ranges, drawd, pcolor, psize, pstype):
@@ -173,9 +197,17 @@ def add_cbar(figmode, cbar_mode, grid, ab, ic, clab, sct, field):
         cbarh = P.colorbar(ab, cax=bar, drawedges=False)
     else:
         cbarh = P.colorbar(ab, cax=bar, format=clf, drawedges=False)
-    cbarh.ax.set_ylabel(clab)
     if cbar_mode == 'none':
         cbarh.ax.yaxis.set_label_coords(ps.cbar_label_coords[0], ps.cbar_label_coords[1])
+    # ticks of an updated frame have to be found again by the original locator
+    autoticks = cbarh.locator, cbarh.formatter
+    label_cbar(cbarh, ic, clab, sct, field)
+    return cbarh, autoticks
+
+
+def label_cbar(cbarh, ic, clab, sct, field):
+    clf = [ps.cbar_hist2d_label_format, ps.cbar_plot2d_label_format][ic]
+    cbarh.ax.set_ylabel(clab)
     if ic == 1 and pu.whether_symlog(sct):
         slticks, sltlabs = [], []
         for tick in cbarh.get_ticks():
@@ -189,8 +221,13 @@ def add_cbar(figmode, cbar_mode, grid, ab, ic, clab, sct, field):
             cbarh.set_ticklabels(sltlabs)
 
 
-def plotcompose(pthfilen, var, output, options):
-    axc, umin, umax, cmap, pcolor, player, psize, sctype, scnorm, pstype, cu, center, cmpr, drawg, drawd, drawu, drawa, drawp, nbins, uaxes, zoom, plotlevels, gridlist, gcolor, linstyl, varlabel = options
+def plotcompose(pthfilen, varlist, outputs, options):
+    axc, umin, umax, cmap, pcolor, player, psize, sctype, scnorm, pstype, cu, center, cmpr, drawg, drawd, drawu, drawa, drawp, nbins, uaxes, zoom, plotlevels, gridlist, gcolor, linstyl, varlabel, memlim, xcache, movie, preview = options
+    if cmpr[0] and len(varlist) > 1:
+        # comparison setup depends on the dataset, so it is done one by one
+        for var, output in zip(varlist, outputs):
+            plotcompose(pthfilen, [var], [output], options)
+        return
     labh = ps.particles_label
     drawh = drawp and nbins > 1
     h5f = h5py.File(pthfilen, 'r')
@@ -199,7 +236,7 @@ def plotcompose(pthfilen, var, output, options):
     ulenf = h5f['dataset_units']['length_unit'].attrs['unit']
     usc, ulen, uupd = pu.change_units(ulenf, uaxes)
     if drawd:
-        uvar = h5f['dataset_units'][var].attrs['unit']
+        uvars = [h5f['dataset_units'][var].attrs['unit'] for var in varlist]
     if drawh:
         umass = h5f['dataset_units']['mass_unit'].attrs['unit']
         labh = labh[:-1] + ' mass histogram' + " [%s]" % pu.labelx()(umass)
@@ -215,8 +252,10 @@ def plotcompose(pthfilen, var, output, options):
 
     timep = "time = %5.2f %s" % (time, pu.labelx()(utim))
     print(timep)
+    if preview > 1:
+        timep = timep + " (preview 1:%d)" % preview
 
-    parts, field = [drawp, ], [drawd, ]
+    parts = [drawp, ]
 
     if not cu:
         center = (smax[0] + smin[0]) / 2.0, (smax[1] + smin[1]) / 2.0, (smax[2] + smin[2]) / 2.0
@@ -224,9 +263,10 @@ def plotcompose(pthfilen, var, output, options):
     drawa, drawu = pu.choose_amr_or_uniform(drawa, drawu, drawd, drawg, drawp, maxglev, gridlist)
     plotlevels = pu.check_plotlevels(plotlevels, maxglev, pthfilen, True)
     gridlist = pu.sanitize_gridlist(gridlist, cgcount)
-    unavail, cmpr, drawa, drawu = rd.manage_compare(cmpr, pthfilen, h5f, var, plotlevels, gridlist, drawa, drawu)
+    unavail, cmpr, drawa, drawu = rd.manage_compare(cmpr, pthfilen, h5f, varlist[0], plotlevels, gridlist, drawa, drawu)
     if len(plotlevels) == 0 or unavail:
         return
+    steps = pu.preview_steps(plotlevels, preview, h5f['simulation_parameters'].attrs['refine_by'][0] if 'refine_by' in h5f['simulation_parameters'].attrs else 2)
 
     linstyl = pu.linestyles(linstyl, maxglev, plotlevels)
     if drawg:
@@ -239,19 +279,10 @@ def plotcompose(pthfilen, var, output, options):
 
     draw1D, draw2D, figmode = pu.check_1D2Ddefaults(axc, n_d, drawd and drawh)
 
-    refis = []
+    centers = [center] * len(varlist)
+    refises = [[]] * len(varlist)
     if drawd or drawg:
-        refis, extr, center = rd.collect_gridlevels(h5f, var, cmpr, refis, maxglev, plotlevels, gridlist, cgcount, center, usc, drawd, drawu, drawa, drawg, draw1D, draw2D)
-
-        if refis == [] or pu.list_any(extr, []):
-            drawd = False
-            field = [drawd, ]
-        else:
-            if drawd:
-                vmin, vmax, symmin, autsc = pu.scale_manage(sctype, refis, umin, umax, draw1D, draw2D, extr)
-
-                vlab = pu.properlabel(var, varlabel, pu.labellog(sctype, symmin, cmpr[0])) + pu.manage_units(uvar)
-                field = drawd, vmin, vmax, symmin, cmap, autsc, vlab
+        refises, extrs, centers = rd.collect_gridlevels(h5f, varlist, cmpr, maxglev, plotlevels, gridlist, cgcount, centers, usc, drawd, drawu, drawa, drawg, draw1D, draw2D, memlim, xcache, steps)
 
     zoom = rd.level_zoom(h5f, gridlist, zoom, smin, smax)
 
@@ -259,14 +290,31 @@ def plotcompose(pthfilen, var, output, options):
     if cmpr[0]:
         cmpr[2].close()
 
-    if not (parts[0] or drawd or drawg):
-        print('No particles or datafields or grids to plot. Skipping.')
-        return
+    for iv in range(len(varlist)):
+        drawdv, field, vlab = drawd, [drawd, ], ''
+        if drawd or drawg:
+            if refises[iv] == [] or pu.list_any(extrs[iv], []):
+                drawdv = False
+                field = [drawdv, ]
+            elif drawd:
+                vmin, vmax, symmin, autsc = pu.scale_manage(sctype, refises[iv], umin, umax, draw1D, draw2D, extrs[iv])
 
-    cbar_mode = pu.colorbar_mode(drawd, drawh, figmode)
+                vlab = pu.properlabel(varlist[iv], varlabel, pu.labellog(sctype, symmin, cmpr[0])) + pu.manage_units(uvars[iv])
+                field = drawdv, vmin, vmax, symmin, cmap, autsc, vlab
+
+        if not (parts[0] or drawdv or drawg):
+            print('No particles or datafields or grids to plot. Skipping.')
+            continue
+
+        equip1d = smin, smax, zoom, ulen, sctype, umin, umax, linstyl, outputs[iv], timep, movie
+        equip2d = smin, smax, zoom, ulen, sctype, scnorm, drawg, gcolor, centers[iv]
+        plotfield(refises[iv], field, parts, equip1d, equip2d, draw1D, draw2D, figmode, drawh, labh, vlab)
 
-    equip1d = smin, smax, zoom, ulen, sctype, umin, umax, linstyl, output, timep
-    equip2d = smin, smax, zoom, ulen, sctype, scnorm, drawg, gcolor, center
+
+def plotfield(refis, field, parts, equip1d, equip2d, draw1D, draw2D, figmode, drawh, labh, vlab):
+    drawd = field[0]
+    sctype, output, timep, movie = equip1d[4], equip1d[8], equip1d[9], equip1d[10]
+    cbar_mode = pu.colorbar_mode(drawd, drawh, figmode)
 
     if draw1D[0]:
         plot1d(refis, field, parts, equip1d, 0, 1, 2)
@@ -277,31 +325,138 @@ def plotcompose(pthfilen, var, output, options):
 
     if any(draw2D):
         fig = P.figure(1, figsize=pu.figsizes[figmode])
+        layout = frame_layout(fig, refis, field, parts, equip2d, draw2D, figmode, cbar_mode)
+        if layout is not None and layout == renderer.layout:
+            renderer.update(refis, field, equip2d, draw2D, sctype, timep, vlab)
+        else:
+            P.clf()
+            renderer.layout = None
+            grid = AxesGrid(fig, 111, nrows_ncols=pu.figrwcls[figmode], axes_pad=ps.plot2d_axes_pad, aspect=True, cbar_mode=cbar_mode, label_mode="L",)
+            ag0, ag2, ag3 = [], [], []
+            comps = []
+
+            if draw2D[0]:
+                ax = grid[pu.figplace[figmode][0]]
+                ax, ims, ah = draw_plotcomponent(ax, refis, field, parts, equip2d, 0, 1, 2)
+                ag3 = ims[-1] if ims != [] else []
+                comps.append((ax, ims, 0, 1, 2))
+
+            if draw2D[1]:
+                ax = grid[pu.figplace[figmode][1]]
+                ax, ims, ah = draw_plotcomponent(ax, refis, field, parts, equip2d, 1, 0, 2)
+                ag2 = ims[-1] if ims != [] else []
+                comps.append((ax, ims, 1, 0, 2))
+
+            if draw2D[2]:
+                ax = grid[pu.figplace[figmode][2]]
+                ax, ims, ah = draw_plotcomponent(ax, refis, field, parts, equip2d, 2, 0, 1)
+                ag0 = ims[-1] if ims != [] else []
+                comps.append((ax, ims, 2, 0, 1))
+            ax.set_title(timep)
+
+            if drawh:
+                add_cbar(figmode, cbar_mode, grid, ah[3], 0, labh, sctype, field)
+
+            cbar = None
+            if drawd:
+                cbar = add_cbar(figmode, cbar_mode, grid, pu.take_nonempty([ag0, ag2, ag3]), 1, vlab, sctype, field)
+            renderer.keep(layout, comps, ax, cbar)
 
-        grid = AxesGrid(fig, 111, nrows_ncols=pu.figrwcls[figmode], axes_pad=ps.plot2d_axes_pad, aspect=True, cbar_mode=cbar_mode, label_mode="L",)
-        ag0, ag2, ag3 = [], [], []
+        P.draw()
+        save_frame(fig, output, pu.plane_in_outputname(figmode, draw2D), movie)
 
-        if draw2D[0]:
-            ax = grid[pu.figplace[figmode][0]]
-            ax, ag3, ah = draw_plotcomponent(ax, refis, field, parts, equip2d, 0, 1, 2)
 
-        if draw2D[1]:
-            ax = grid[pu.figplace[figmode][1]]
-            ax, ag2, ah = draw_plotcomponent(ax, refis, field, parts, equip2d, 1, 0, 2)
+class FrameRenderer:
+    # keeps the 2D figure with its axes and colorbar, consecutive frames of the same layout only update data, ranges and labels
 
-        if draw2D[2]:
-            ax = grid[pu.figplace[figmode][2]]
-            ax, ag0, ah = draw_plotcomponent(ax, refis, field, parts, equip2d, 2, 0, 1)
-        ax.set_title(timep)
+    def __init__(self):
+        self.layout = None
 
-        if drawh:
-            add_cbar(figmode, cbar_mode, grid, ah[3], 0, labh, sctype, field)
+    def keep(self, layout, comps, tax, cbar):
+        self.layout, self.comps, self.tax, self.cbar = layout, comps, tax, cbar
 
-        if drawd:
-            add_cbar(figmode, cbar_mode, grid, pu.take_nonempty([ag0, ag2, ag3]), 1, vlab, sctype, field)
+    def update(self, refis, field, equip2d, draw2D, sctype, timep, vlab):
+        if self.cbar is not None:
+            cbarh, autoticks = self.cbar
+            cbarh.locator, cbarh.formatter = autoticks
+        for ax, ims, ncut, n1, n2 in self.comps:
+            update_plotcomponent(ax, ims, refis, field, equip2d, ncut, n1, n2)
+        self.tax.set_title(timep)
+        if self.cbar is not None:
+            label_cbar(cbarh, 1, vlab, sctype, field)
 
-        P.draw()
-        out2d = output[0] + pu.plane_in_outputname(figmode, draw2D) + output[1]
-        P.savefig(out2d, facecolor=ps.f_facecolor)
-        print(out2d, "written to disk")
-        P.clf()
+
+renderer = FrameRenderer()
+
+
+def frame_layout(fig, refis, field, parts, equip2d, draw2D, figmode, cbar_mode):
+    # everything drawn only once into the figure; particles are always drawn anew
+    if parts[0]:
+        return None
+    scnorm, drawg, gcolor = equip2d[5:8]
+    blocks = []
+    for ncut in range(3):
+        if draw2D[ncut]:
+            for blks in refis:
+                for bl in blks:
+                    bxyz, binb, ble, bre, level = bl[:-1]
+                    if binb[ncut]:
+                        blocks.append((ncut, level, tuple(ble), tuple(bre), np.shape(bxyz[ncut]) if bxyz != [] else None))
+    return fig, figmode, cbar_mode, tuple(draw2D), tuple(field[:1] + field[4:6]), scnorm, drawg, tuple(gcolor), tuple(blocks)
+
+
+def save_frame(fig, output, plane, movie):
+    if movie[0] == '':
+        out = output[0] + plane + output[1]
+        fig.savefig(out, facecolor=ps.f_facecolor)
+        print(out, "written to disk")
+        return
+    # frames of the same datafield and cut from consecutive files go to one movie
+    mname = (output[0] + plane).rstrip('_') + '.' + movie[0]
+    if mname not in movies:
+        movies[mname] = movie_writer(fig, mname, movie)
+    movies[mname].grab_frame(facecolor=ps.f_facecolor)
+    print('Frame appended to', movies[mname].outfile)
+
+
+def movie_format(ext):
+    if ext not in ('gif', 'png') and not manimation.writers.is_available('ffmpeg'):
+        print('ffmpeg not available, writing %s movies instead of %s' % (ps.movie_fallback, ext))
+        return ps.movie_fallback
+    return ext
+
+
+def movie_writer(fig, mname, movie):
+    ext, fps = movie
+    if ext in ('gif', 'png'):
+        # Pillow keeps all frames in memory and writes GIF or APNG at the end
+        writer = manimation.PillowWriter(fps=fps)
+    else:
+        writer = manimation.FFMpegWriter(fps=fps)
+    writer.setup(fig, mname)
+    return writer
+
+
+def finish_movies():
+    for mname in sorted(movies):
+        movies[mname].finish()
+        print(movies[mname].outfile, "written to disk")
+    movies.clear()
+
+
+def init_job():
+    # workers never show figures, so avoid touching any display
+    P.switch_backend('agg')
+
+
+def plotcompose_job(job):
+    pthfilen, varlist, outputs, options = job
+    log = io.StringIO()
+    failure = ''
+    with contextlib.redirect_stdout(log):
+        try:
+            plotcompose(pthfilen, varlist, outputs, options)
+        except Exception:
+            failure = traceback.format_exc()
+    P.close('all')
+    return pthfilen, varlist, log.getvalue(), failure
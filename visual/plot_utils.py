@@ -83,7 +83,7 @@ def scale_translate(sctype, vmn, vmx, sm, hbd):
 def scale_manage(sctype, refis, umin, umax, d1, d2, extr):
     symmin = 1.0
     autoscale = False
-    d1min, d1max, d2min, d2max, d3min, d3max = min(extr[0]), max(extr[1]), min(extr[2]), max(extr[3]), min(extr[4]), max(extr[5])
+    d1min, d1max, d2min, d2max = min(extr[0]), max(extr[1]), min(extr[2]), max(extr[3])
     if any(d1) and any(d2):
         dmin, dmax = min(d1min, d2min), max(d1max, d2max)
     elif any(d2):
@@ -132,7 +132,6 @@ def scale_manage(sctype, refis, umin, umax, d1, d2, extr):
         vmin = vmin - ps.fineqv
         vmax = vmax + ps.fineqv
 
-    print('3D data value range: ', d3min, d3max)
     if any(d2):
         print('Slices  value range: ', d2min, d2max)
     if any(d1):
@@ -421,6 +420,22 @@ def check_plotlevels(plotlevels, maxglev, filen, toplot):
     return plotlevels
 
 
+def preview_steps(plotlevels, preview, refine_by):
+    # strides reducing resolution of the finest plotted level preview times; levels finer than a coarser plotted level which already reaches it are omitted
+    steps = {}
+    if preview <= 1 or len(plotlevels) == 0:
+        return steps
+    maxlev = max(plotlevels)
+    coarser = None
+    for lev in sorted(plotlevels):
+        if coarser is not None and refine_by ** (maxlev - coarser) <= preview:
+            continue
+        steps[lev] = max(1, preview // refine_by ** (maxlev - lev))
+        coarser = lev
+    print('Preview levels and strides: ', steps)
+    return steps
+
+
 def sanitize_gridlist(gridlist, cgcount):
     if gridlist == '':
         gridlist = range(cgcount)
@@ -3,6 +3,7 @@
 
 import getopt
 import h5py
+import multiprocessing as mp
 import os
 import sys
 import plot_compose as pc
@@ -34,6 +35,11 @@ dnames = ''
 uaxes = ''
 nbins = 1
 player = True, '0', '0', '0'
+njobs = 1
+memlim = ps.uniform_memlimit
+xcache = ps.extrema_cache
+movie = '', ps.movie_fps
+preview = 1
 
 print('PIERNIK VISUALIZATION FACILITY')
 
@@ -58,14 +64,20 @@ def print_usage():
     print('\t\t\t--compare-type TYPE \t\t\toperation executed as a comparison: 1 - subtraction, 2 - division, 3 - relative error [default: %s]' % ps.plot2d_comparetype)
     print(' -e EXTENSION, \t\t--extension EXTENSION \t\t\tsave plot in file using filename extension EXTENSION [default: %s]' % ps.f_exten[1:])
     print(' -F FILE\t\t--compare-file FILE \t\t\tcompare chosen datafields to another FILE')
+    print('\t\t\t--fps FPS \t\t\t\tframe rate of movies [default: %s]' % ps.movie_fps)
     print(' -g COLOR, \t\t--gridcolor COLOR \t\t\tshow grids in color COLOR; possible list of colors for different grid refinement levels [default: none]')
     print('\t\t\t--grid-list GRID1[,GRID2] \t\tplot only selected numbered grid blocks [default: all existing blocks]')
+    print(' -j N, \t\t\t--jobs N \t\t\t\trender plots in N parallel processes [default: 1]')
+    print('\t\t\t--memory-limit MB \t\t\tkeep uniform grid volumes larger than MB megabytes in memory-mapped scratch files [default: %s]' % ps.uniform_memlimit)
     print(' -l LEVEL1[,LEVEL2], \t--level LEVEL1[,LEVEL2] \t\tplot only requested grid levels [default: all]')
     print(' -L LEVEL1[,LEVEL2]\t--compare-level LEVEL1[,LEVEL2] \tspecify different grid levels to compare accross files [default: the same levels]')
     print('\t\t\t--linestyle STYLELIST \t\t\tline styles list for different refinement levels in 1D plots [default: %s]' % ps.plot1d_linestyle)
+    print(' -m EXTENSION, \t\t--movie EXTENSION \t\t\tstream frames of all files into movies with EXTENSION (mp4, avi, gif, png, ...) instead of writing separate plot files; without ffmpeg falls back to %s [default: switched-off]' % ps.movie_fallback)
+    print('\t\t\t--no-extrema-cache \t\t\tdo not use nor write sidecar files with block extrema for --center max/min [default: use them]')
     print(' -n LABEL, \t\t--varlabel LABEL \t\t\tuse VAR or LABEL as label to describe plotted datafield or translate it (possible values: 0 | var, 1 | describe, 2 | symbol, LABEL (directly)) [default: %s]' % ps.cbar_varlabel)
     print(' -o OUTPUT, \t\t--output OUTPUT \t\t\tdump plot files into OUTPUT directory [default: %s]' % ps.f_plotdir)
     print(' -p,\t\t\t--particles\t\t\t\tscatter particles onto slices [default: switched-off]')
+    print('\t\t\t--preview FACTOR \t\t\tquick look reading every FACTOR-th cell of blocks along plotted cuts and only coarser levels when they reach such resolution [default: 1, full resolution]')
     print(' -P,\t\t\t--particle-color\t\t\tuse color for particles scattering or colormap for particles histogram plot [default: %s or %s]' % (ps.particles_color, ps.hist2d_colormap))
     print(' -r W1[,W2,W3],\t\t--particle-slice W1[,W2,W3]\t\tread particles from layers +/-W1 around center; uses different widths for different projections if W1,W2,W3 requested [default: all particles]')
     print(' -R W1[,W2,W3],\t\t--particle-space W1[,W2,W3]\t\tread particles from square +/-W1 around center or cuboid if W1,W2,W3 requested [default: no limits]')
@@ -81,7 +93,7 @@ def print_usage():
 
 def cli_params(argv):
     try:
-        opts, args = getopt.getopt(argv, "a:b:c:Cd:D:e:F:g:hl:L:n:o:pP:r:R:s:t:T:u:v:z:", ["help", "amr", "axes=", "bins=", "center=", "colormap=", "compare-adjusted-grids", "compare-datafield=", "compare-file=", "compare-level=", "compare-type=", "dataset=", "extension=", "gridcolor=", "grid-list=", "level=", "linestyle=", "output=", "particles", "particle-color=", "particle-h2d-scale=", "particle-space=", "particle-sizes=", "particle-slice=", "scale=", "scalenorm=", "uniform", "units=", "varlabel=", "zlim=", "zoom="])
+        opts, args = getopt.getopt(argv, "a:b:c:Cd:D:e:F:g:hj:l:L:m:n:o:pP:r:R:s:t:T:u:v:z:", ["help", "amr", "axes=", "bins=", "center=", "colormap=", "compare-adjusted-grids", "compare-datafield=", "compare-file=", "compare-level=", "compare-type=", "dataset=", "extension=", "fps=", "gridcolor=", "grid-list=", "jobs=", "level=", "linestyle=", "memory-limit=", "movie=", "no-extrema-cache", "output=", "particles", "particle-color=", "particle-h2d-scale=", "particle-space=", "particle-sizes=", "particle-slice=", "preview=", "scale=", "scalenorm=", "uniform", "units=", "varlabel=", "zlim=", "zoom="])
     except getopt.GetoptError:
         print("Unrecognized options: %s \n" % argv)
         print_usage()
@@ -154,11 +166,19 @@ def cli_params(argv):
             exten = '.' + str(arg)
             print(exten)
 
+        elif pu.recognize_opt(opt, ("--fps",)):
+            global movie
+            movie = movie[0], float(arg)
+
         elif pu.recognize_opt(opt, ("-g", "--gridcolor")):
             global gcolor, draw_grid
             gcolor = str(arg)
             draw_grid = True
 
+        elif pu.recognize_opt(opt, ("-j", "--jobs")):
+            global njobs
+            njobs = max(1, int(arg))
+
         elif pu.recognize_opt(opt, ("-l", "--level")):
             global plotlevels
             plotlevels = [int(i) for i in arg.split(',')]
@@ -172,6 +192,17 @@ def cli_params(argv):
             global linstyl
             linstyl = arg.split(',')
 
+        elif pu.recognize_opt(opt, ("--memory-limit",)):
+            global memlim
+            memlim = float(arg)
+
+        elif pu.recognize_opt(opt, ("-m", "--movie")):
+            movie = arg.lstrip('.'), movie[1]
+
+        elif pu.recognize_opt(opt, ("--no-extrema-cache",)):
+            global xcache
+            xcache = False
+
         elif pu.recognize_opt(opt, ("-n", "--varlabel")):
             global varlabel
             varlabel = str(arg)
@@ -197,6 +228,10 @@ def cli_params(argv):
             else:
                 player = True, aux[0], aux[0], aux[0]
 
+        elif pu.recognize_opt(opt, ("--preview",)):
+            global preview
+            preview = max(1, int(arg))
+
         elif pu.recognize_opt(opt, ("-R", "--particle-space")):
             aux = arg.split(',')
             if len(aux) >= 3:
@@ -315,12 +350,20 @@ if '1z' in axcuts:
     p1z = True
 axc = [p1x, p1y, p1z], [p2yz, p2xz, p2xy]
 
+if movie[0] != '':
+    movie = pc.movie_format(movie[0]), movie[1]
+    if njobs > 1:
+        print('Movie frames have to be rendered in order, ignoring --jobs')
+        njobs = 1
+
 compare = cmpr, cmprb, cmprf, cmprd, cmprl, cmprt, False
 
-options = axc, zmin, zmax, cmap, pcolor, player, psize, sctype, scnorm, pstype, cu, center, compare, draw_grid, draw_data, draw_uni, draw_amr, draw_part, nbins, uaxes, zoom, plotlevels, gridlist, gcolor, linstyl, varlabel
+options = axc, zmin, zmax, cmap, pcolor, player, psize, sctype, scnorm, pstype, cu, center, compare, draw_grid, draw_data, draw_uni, draw_amr, draw_part, nbins, uaxes, zoom, plotlevels, gridlist, gcolor, linstyl, varlabel, memlim, xcache, movie, preview
+prvn = '_preview%d' % preview if preview > 1 else ''
 if not os.path.exists(plotdir):
     os.makedirs(plotdir)
 
+jobs = []
 for pthfilen in files_list:
     print('')
     file_exists = os.path.exists(pthfilen)
@@ -365,13 +408,48 @@ for pthfilen in files_list:
     if varlist != []:
         print('Going to read ' + prp + prd + prg)
 
+    fvars, fouts = [], []
     for var in varlist:
         if (not draw_data or var in list(h5f['field_types'].keys())):
             # output = plotdir+'/'+filen.split('/')[-1].replace('.h5',"_%s.png" % var)
             fnl = filen.split('/')[-1]
-            output = [plotdir + '/' + '_'.join(fnl.split('_')[:-1]) + '_' + var + cmprn + '_', fnl.split('_')[-1].replace('.h5', exten)]
-            pc.plotcompose(pthfilen, var, output, options)
+            fvars.append(var)
+            fouts.append([plotdir + '/' + '_'.join(fnl.split('_')[:-1]) + '_' + var + cmprn + prvn + '_', fnl.split('_')[-1].replace('.h5', exten)])
         else:
             print(var, ' is not available in the file ', pthfilen)
 
     h5f.close()
+
+    if fvars == []:
+        continue
+    if njobs == 1:
+        pc.plotcompose(pthfilen, fvars, fouts, options)
+    elif len(files_list) >= njobs:
+        jobs.append((pthfilen, fvars, fouts, options))
+    else:
+        # too few files to keep all processes busy, so split datasets instead of reading them at once
+        for var, output in zip(fvars, fouts):
+            jobs.append((pthfilen, [var], [output], options))
+
+if movie[0] != '':
+    pc.finish_movies()
+
+if jobs != []:
+    # fork keeps the already parsed options and loaded modules in the workers
+    if 'fork' in mp.get_all_start_methods():
+        ctx = mp.get_context('fork')
+    else:
+        ctx = mp.get_context()
+    print('Rendering %d jobs in %d processes' % (len(jobs), njobs))
+    failures = []
+    with ctx.Pool(processes=njobs, initializer=pc.init_job) as pool:
+        for pthfilen, fvars, log, failure in pool.imap(pc.plotcompose_job, jobs):
+            print(log, end='')
+            if failure != '':
+                print(failure, end='')
+                failures.append((pthfilen, fvars))
+    if failures != []:
+        print('\nFailed %d out of %d jobs:' % (len(failures), len(jobs)))
+        for pthfilen, fvars in failures:
+            print('   ', pthfilen, ', '.join(fvars))
+        sys.exit(1)
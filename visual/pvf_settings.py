@@ -11,6 +11,17 @@ f_exten = '.png'
 f_plotdir = 'frames'
 f_facecolor = 'white'
 
+# movies
+movie_fps = 10
+movie_fallback = 'gif'  # used when ffmpeg is not available, 'gif' or 'png' (APNG) written by Pillow
+
+# uniform grid reconstruction
+uniform_memlimit = 2048  # MB, larger volumes are kept in memory-mapped scratch files (see TMPDIR)
+
+# extrema of blocks found for plot center 'max' or 'min', kept in hidden sidecar files next to the HDF5 files
+extrema_cache = True
+extrema_cache_suffix = '.pvf_extrema.npz'
+
 # 1D plots
 plot1d_linecolor = 'k'
 plot1d_linestyle = ['-', '--', ':']
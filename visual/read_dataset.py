@@ -1,9 +1,91 @@
 #!/usr/bin/env python
 import h5py as h5
 import numpy as np
+import os
+import tempfile
+import zipfile
 import plot_utils as pu
 import pvf_settings as ps
 
+grid_index_cache = []
+extrema_dtype = [('known', '?'), ('min', 'f8'), ('max', 'f8'), ('imin', 'i8', 3), ('imax', 'i8', 3)]
+
+
+class GridIndex:
+    # Vectorized description of all grid blocks built once from the GDF top-level arrays
+
+    def __init__(self, h5f):
+        level = h5f['grid_level'][:]
+        off = h5f['grid_left_index'][:, :]
+        n_b = h5f['grid_dimensions'][:, :]
+        sp = h5f['simulation_parameters'].attrs
+        dle, dre = sp['domain_left_edge'], sp['domain_right_edge']
+        n_d = sp['domain_dimensions']
+        refine_by = sp['refine_by'][0] if 'refine_by' in sp else 2
+
+        self.blocks = np.zeros(level.size, dtype=[('level', 'i4'), ('off', 'i8', 3), ('n_b', 'i8', 3), ('left_edge', 'f8', 3), ('right_edge', 'f8', 3), ('n_part', 'i8')])
+        self.blocks['level'] = level
+        self.blocks['off'] = off
+        self.blocks['n_b'] = n_b
+        # -1 stands for unknown number of particles
+        if 'grid_particle_count' in h5f:
+            self.blocks['n_part'] = h5f['grid_particle_count'][...].reshape(level.size, -1)[:, 0]
+        else:
+            self.blocks['n_part'] = -1
+        # the same formula as for grid_container%fbnd, the domain edges are kept for absent dimensions
+        dl = (dre - dle) / (n_d * refine_by ** level[:, np.newaxis].astype(float))
+        self.blocks['left_edge'] = np.where(n_d > 1, dle + dl * off, dle)
+        self.blocks['right_edge'] = np.where(n_d > 1, dle + dl * (off + n_b), dre)
+
+    def __len__(self):
+        return self.blocks.size
+
+    def in_gridlist(self, gridlist):
+        mask = np.zeros(self.blocks.size, dtype=bool)
+        mask[np.asarray(list(gridlist), dtype=int)] = True
+        return mask
+
+    def on_level(self, level, gridlist=None):
+        mask = self.blocks['level'] == level
+        if gridlist is not None:
+            mask &= self.in_gridlist(gridlist)
+        return mask
+
+    def crossing(self, axis, coord):
+        # blocks intersecting plane perpendicular to axis at coord
+        return (self.blocks['left_edge'][:, axis] <= coord) & (coord <= self.blocks['right_edge'][:, axis])
+
+    def crossing_cuts(self, center, draw1D, draw2D):
+        # blocks contributing to plotted planes and lines through center, as decided by plot_utils.find_indices
+        inbox = np.stack([self.crossing(axis, center[axis]) for axis in range(3)], axis=1)
+        inb = inbox & np.asarray(draw2D, dtype=bool)
+        for axis in range(3):
+            if draw1D[axis]:
+                for other in range(3):
+                    if other != axis:
+                        inb[:, other] |= inbox[:, other]
+        return inb.any(axis=1)
+
+    def ids(self, mask):
+        return np.flatnonzero(mask)
+
+    def bounding_box(self, level, gridlist=None):
+        blks = self.blocks[self.on_level(level, gridlist)]
+        if blks.size == 0:
+            return None
+        return blks['off'].min(axis=0), (blks['off'] + blks['n_b']).max(axis=0), blks['left_edge'].min(axis=0), blks['right_edge'].max(axis=0)
+
+
+def grid_index(h5f):
+    # indices of the two most recently used files are kept (plotted and compared ones)
+    for h5i, gidx in grid_index_cache:
+        if h5i is h5f:
+            return gidx
+    gidx = GridIndex(h5f)
+    grid_index_cache.insert(0, (h5f, gidx))
+    del grid_index_cache[2:]
+    return gidx
+
 
 def manage_compare(cmpr, pthfilen, h5f, var, plotlevels, gridlist, drawa, drawu):
     cmpr0, cmprb, cmprf, cmprd, cmprl, cmprt, diff_struct = cmpr
@@ -38,24 +120,25 @@ def manage_compare(cmpr, pthfilen, h5f, var, plotlevels, gridlist, drawa, drawu)
 def compare_grids(h1, h2, plotlevels, cmprl, gridlist):
     if len(plotlevels) != len(cmprl):
         return True
-    cgcnt2 = cgcount = int(h2['data'].attrs['cg_count'])
+    if len(plotlevels) == 0 or len(gridlist) == 0:
+        return False
+    ids = np.asarray(list(gridlist), dtype=int)
+    gidx2 = grid_index(h2)
+    if ids.max() >= len(gidx2):
+        return True
+    b1, b2 = grid_index(h1).blocks[ids], gidx2.blocks[ids]
     for il in range(len(plotlevels)):
-        for ig in gridlist:
-            h5g1 = h1['data']['grid_' + str(ig).zfill(10)]
-            if ig >= cgcnt2:
-                return True
-            h5g2 = h2['data']['grid_' + str(ig).zfill(10)]
-            if h5g1.attrs['level'] == plotlevels[il]:
-                if h5g2.attrs['level'] != cmprl[il]:
-                    return True
-                if any(h5g1.attrs['off'] != h5g2.attrs['off']):
-                    return True
-                if any(h5g1.attrs['n_b'] != h5g2.attrs['n_b']):
-                    return True
+        mask = b1['level'] == plotlevels[il]
+        if any(b2['level'][mask] != cmprl[il]):
+            return True
+        if (b1['off'][mask] != b2['off'][mask]).any():
+            return True
+        if (b1['n_b'][mask] != b2['n_b'][mask]).any():
+            return True
     return False
 
 
-def reconstruct_uniform(h5f, var, cmpr, levnum, level, gridlist, center, usc, draw1D, draw2D):
+def reconstruct_uniform(h5f, varlist, cmpr, levnum, level, gridlist, centers, usc, draw1D, draw2D, memlim, step):
     # attrs = h5f['domains']['base'].attrs
     # nd = [i * 2**level for i in attrs['n_d']]
     nd, loff, roff, ledg, redg, levelmet = frame_level(h5f, level, gridlist)
@@ -99,74 +182,145 @@ def reconstruct_uniform(h5f, var, cmpr, levnum, level, gridlist, center, usc, dr
             print('Comparison for levels: %s and %s not available due to unmet resolution constraints. Dimensions %s and %s do not match.' % (level, cmprl[levnum], nd, ndc))
             return False, [], []
 
-    dset = collect_dataset(h5f, var, cmpr, level, gridlist, nd, loff)
-    if diff_struct:
-        dc = collect_dataset(h5c, cmprd, cmpr, cmprl[levnum], range(int(h5c['data'].attrs['cg_count'])), ndc, loc)
-        if nd == ndc:
-            dset = pu.execute_comparison(dset, dc, cmprt)
-
-    if center is None:
-        return pu.locate_extrema(dset, ledg, redg, nd)
-
-    inb, ind = pu.find_indices(nd, center, ledg, redg, draw1D, draw2D, True)
-    print('Plot center', center[0], center[1], center[2], 'gives indices:', ind[0], ind[1], ind[2], 'for uniform grid level', level)
-
-    b2d, b1d, extr = take_cuts_and_lines(dset, ind, draw1D, draw2D)
-    block = b2d, inb, pu.list3_division(ledg, usc), pu.list3_division(redg, usc), level, b1d
-
-    return levelmet, block, extr
+    if centers is None:
+        # whole volumes are needed here to locate extrema
+        if diff_struct:
+            memlim = memlim / float(len(varlist) + 1) * len(varlist)
+        dsets = collect_dataset(h5f, varlist, cmpr, level, gridlist, nd, loff, memlim)
+        if diff_struct:
+            dc = collect_dataset(h5c, [cmprd], cmpr, cmprl[levnum], range(int(h5c['data'].attrs['cg_count'])), ndc, loc, memlim / len(varlist))[0]
+            if nd == ndc:
+                dsets = [compare_volumes(dset, dc, cmprt, memlim) for dset in dsets]
+
+        bextrs, cextrs = [], []
+        for dset in dsets:
+            levok, bextr, cextr = pu.locate_extrema(dset, ledg, redg, nd)
+            bextrs.append(bextr)
+            cextrs.append(cextr)
+        return levelmet, bextrs, cextrs
+
+    inbs, inds = [], []
+    for center in centers:
+        inb, ind = pu.find_indices(nd, center, ledg, redg, draw1D, draw2D, True)
+        print('Plot center', center[0], center[1], center[2], 'gives indices:', ind[0], ind[1], ind[2], 'for uniform grid level', level)
+        inbs.append(inb)
+        inds.append(ind)
+
+    cuts = collect_cuts(h5f, varlist, cmpr, level, gridlist, nd, loff, inds, draw1D, draw2D, step)
+    if diff_struct and nd == ndc:
+        ccuts = collect_cuts(h5c, [cmprd] * len(varlist), cmpr, cmprl[levnum], range(int(h5c['data'].attrs['cg_count'])), ndc, loc, inds, draw1D, draw2D, step)
+        cuts = [compare_cuts_and_lines(cut, ccut, cmprt, draw1D, draw2D) for cut, ccut in zip(cuts, ccuts)]
+
+    blocks, extrs = [], []
+    for iv in range(len(varlist)):
+        b2d, b1d = cuts[iv]
+        blocks.append([b2d, inbs[iv], pu.list3_division(ledg, usc), pu.list3_division(redg, usc), level, b1d])
+        extrs.append(cuts_and_lines_extrema(b2d, b1d, draw1D, draw2D))
+
+    return levelmet, blocks, extrs
+
+
+def uniform_volume(nd, memlim):
+    # NaN-filled volume, memory-mapped to a scratch file when it exceeds memlim MB
+    if np.prod(nd, dtype=float) * 8. <= memlim * 2.**20:
+        return np.full((nd[0], nd[1], nd[2]), np.nan)
+    print('Volume of %s cells exceeds memory limit of %s MB, using scratch file' % (nd, memlim))
+    vol = np.memmap(tempfile.TemporaryFile(), dtype=float, mode='w+', shape=(nd[0], nd[1], nd[2]))
+    for sl in volume_tiles(nd, memlim):
+        vol[sl] = np.nan
+    return vol
+
+
+def volume_tiles(nd, memlim):
+    # slices of the first axis small enough to be processed within memlim MB
+    step = max(1, int(memlim * 2.**20 / (8. * nd[1] * nd[2])))
+    return [slice(i, min(i + step, nd[0])) for i in range(0, nd[0], step)]
+
+
+def compare_volumes(dset, dc, cmprt, memlim):
+    if not isinstance(dset, np.memmap):
+        return pu.execute_comparison(dset, dc, cmprt)
+    for sl in volume_tiles(dset.shape, memlim / 3.):
+        dset[sl] = pu.execute_comparison(dset[sl], dc[sl], cmprt)
+    return dset
 
 
-def collect_dataset(h5f, dset_name, cmpr, level, gridlist, nd, loff):
-    print('Reading', dset_name)
-    dset = np.full((nd[0], nd[1], nd[2]), np.nan)
+def collect_dataset(h5f, dset_names, cmpr, level, gridlist, nd, loff, memlim):
+    print('Reading', ', '.join(dset_names))
+    dsets = [uniform_volume(nd, memlim / len(dset_names)) for dset_name in dset_names]
+    cmpr0, cmprb, h5c, cmprd, cmprl, cmprt, diff_struct = cmpr
 
     print('Reconstructing domain from cg parts')
-    for ig in gridlist:
+    gidx = grid_index(h5f)
+    for ig in gidx.ids(gidx.on_level(level, gridlist)):
         h5g = h5f['data']['grid_' + str(ig).zfill(10)]
-        if h5g.attrs['level'] == level:
-            off = h5g.attrs['off'] - loff
-            ngb = h5g.attrs['n_b']
-            n_b = [int(ngb[0]), int(ngb[1]), int(ngb[2])]
-            ce = n_b + off
+        off = gidx.blocks['off'][ig] - loff
+        ce = gidx.blocks['n_b'][ig] + off
+        for dset, dset_name in zip(dsets, dset_names):
             dset[off[0]:ce[0], off[1]:ce[1], off[2]:ce[2]] = h5g[dset_name][:, :, :].swapaxes(0, 2)
-            cmpr0, cmprb, h5c, cmprd, cmprl, cmprt, diff_struct = cmpr
             if cmpr0 and not diff_struct:
                 dset[off[0]:ce[0], off[1]:ce[1], off[2]:ce[2]] = pu.execute_comparison(dset[off[0]:ce[0], off[1]:ce[1], off[2]:ce[2]], h5c['data']['grid_' + str(ig).zfill(10)][cmprd][:, :, :].swapaxes(0, 2), cmprt)
 
-    return dset
+    return dsets
 
 
-def frame_level(h5f, level, gridlist):
-    levelmet = False
-    off_started = False
-    for ig in gridlist:
+def collect_cuts(h5f, dset_names, cmpr, level, gridlist, nd, loff, inds, draw1D, draw2D, step):
+    # assemble only planes and lines crossing inds (one per dataset) from the blocks they intersect, every step-th cell along them
+    print('Reading', ', '.join(dset_names))
+    cmpr0, cmprb, h5c, cmprd, cmprl, cmprt, diff_struct = cmpr
+    ns = [len(range(0, nd[i], step)) for i in range(3)]
+    cuts = []
+    for ind in inds:
+        b2d = [np.full((ns[2], ns[1]), np.nan) if draw2D[0] else [], np.full((ns[2], ns[0]), np.nan) if draw2D[1] else [], np.full((ns[1], ns[0]), np.nan) if draw2D[2] else []]
+        b1d = [np.full(ns[i], np.nan) if draw1D[i] else [] for i in range(3)]
+        cuts.append([b2d, b1d])
+
+    print('Reconstructing cuts from cg parts')
+    gidx = grid_index(h5f)
+    for ig in gidx.ids(gidx.on_level(level, gridlist)):
         h5g = h5f['data']['grid_' + str(ig).zfill(10)]
-        if h5g.attrs['level'] == level:
-            levelmet = True
-            off = h5g.attrs['off']
-            ngb = h5g.attrs['n_b']
-            lft = h5g.attrs['left_edge']
-            rht = h5g.attrs['right_edge']
-
-            n_b = [int(ngb[0]), int(ngb[1]), int(ngb[2])]
-            ce = n_b + off
-            if off_started:
-                lind = pu.list3_min(lind, off)
-                rind = pu.list3_max(rind, ce)
-                ledg = pu.list3_min(ledg, lft)
-                redg = pu.list3_max(redg, rht)
-            else:
-                lind = off
-                rind = ce
-                ledg = lft
-                redg = rht
-                off_started = True
-    nd = pu.list3_subtraction(rind, lind)
-    if levelmet:
-        return nd, lind, rind, ledg, redg, levelmet
-    else:
+        off = gidx.blocks['off'][ig] - loff
+        ce = gidx.blocks['n_b'][ig] + off
+        sls, soff, sce = strided_slices(off, gidx.blocks['n_b'][ig], step)
+        for cut, dset_name, ind in zip(cuts, dset_names, inds):
+            crosses = [off[i] <= ind[i] and ind[i] < ce[i] for i in range(3)]
+            drw2D = pu.list3_and(draw2D, crosses)
+            drw1D = pu.list3_and(draw1D, [crosses[1] and crosses[2], crosses[0] and crosses[2], crosses[0] and crosses[1]])
+            if not (any(drw2D) or any(drw1D)):
+                continue
+            lind = pu.list3_subtraction(ind, off)
+            b2d, b1d = read_cuts_and_lines(h5g[dset_name], lind, sls, drw1D, drw2D)
+            if cmpr0 and not diff_struct:
+                c2d, c1d = read_cuts_and_lines(h5c['data']['grid_' + str(ig).zfill(10)][cmprd], lind, sls, drw1D, drw2D)
+                b2d, b1d = compare_cuts_and_lines([b2d, b1d], [c2d, c1d], cmprt, drw1D, drw2D)
+            if drw2D[0]:
+                cut[0][0][soff[2]:sce[2], soff[1]:sce[1]] = b2d[0]
+            if drw2D[1]:
+                cut[0][1][soff[2]:sce[2], soff[0]:sce[0]] = b2d[1]
+            if drw2D[2]:
+                cut[0][2][soff[1]:sce[1], soff[0]:sce[0]] = b2d[2]
+            for i in range(3):
+                if drw1D[i]:
+                    cut[1][i][soff[i]:sce[i]] = b1d[i]
+
+    return cuts
+
+
+def strided_slices(off, n_b, step):
+    # local slices of a block at off taking every step-th cell of the whole level frame, and their range in the strided frame
+    first = [-off[i] % step for i in range(3)]
+    soff = [(off[i] + first[i]) // step for i in range(3)]
+    sce = [soff[i] + len(range(first[i], n_b[i], step)) for i in range(3)]
+    return [slice(first[i], None, step) for i in range(3)], soff, sce
+
+
+def frame_level(h5f, level, gridlist):
+    frame = grid_index(h5f).bounding_box(level, gridlist)
+    if frame is None:
         return [], [], [], [], [], False
+    lind, rind, ledg, redg = [list(i) for i in frame]
+    nd = pu.list3_subtraction(rind, lind)
+    return nd, lind, rind, ledg, redg, True
 
 
 def level_zoom(h5f, gridlist, zoom, smin, smax):
@@ -182,134 +336,295 @@ def level_zoom(h5f, gridlist, zoom, smin, smax):
     return zoom
 
 
-def collect_gridlevels(h5f, var, cmpr, refis, maxglev, plotlevels, gridlist, cgcount, center, usc, getmap, drawu, drawa, drawg, draw1D, draw2D):
-    if len(center) != 3:
-        curmin, curmax = np.inf, -np.inf
-        locmin, locmax = None, None
+def extrema_cache_name(pthfilen):
+    return os.path.join(os.path.dirname(pthfilen), '.' + os.path.basename(pthfilen) + ps.extrema_cache_suffix)
+
+
+def extrema_cache_key(pthfilen):
+    fstat = os.stat(pthfilen)
+    return np.array([os.path.abspath(pthfilen), str(fstat.st_mtime_ns), str(fstat.st_size)])
+
+
+def load_extrema_cache(pthfilen):
+    cache = {}
+    try:
+        with np.load(extrema_cache_name(pthfilen)) as npz:
+            if '__key__' in npz.files and np.array_equal(npz['__key__'], extrema_cache_key(pthfilen)):
+                for name in npz.files:
+                    if name != '__key__':
+                        cache[name] = npz[name]
+                        if cache[name].dtype != np.dtype(extrema_dtype):
+                            raise ValueError(name)
+    except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+        # missing, stale or corrupt sidecar files are rebuilt
+        cache = {}
+    return cache
+
+
+def save_extrema_cache(pthfilen, cache):
+    # other processes may have cached other datasets of the same file meanwhile
+    merged = load_extrema_cache(pthfilen)
+    merged.update(cache)
+    cname = extrema_cache_name(pthfilen)
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(cname), prefix=os.path.basename(cname), suffix='.npz', delete=False) as tmpf:
+            np.savez(tmpf, __key__=extrema_cache_key(pthfilen), **merged)
+        os.replace(tmpf.name, cname)
+    except OSError:
+        print('Cannot write block extrema cache %s' % cname)
+
+
+def block_extrema(h5f, dset_names, ids):
+    # minima, maxima and their [x, y, z] indices for blocks ids, read from the sidecar cache when possible
+    nblk = len(grid_index(h5f))
+    cache = load_extrema_cache(h5f.filename)
+    bexts = []
+    for name in dset_names:
+        if name not in cache or cache[name].size != nblk:
+            cache[name] = np.zeros(nblk, dtype=extrema_dtype)
+        bexts.append(cache[name])
+    todo = [ig for ig in ids if not all([bext['known'][ig] for bext in bexts])]
+    if todo == []:
+        print('Block extrema taken from %s' % extrema_cache_name(h5f.filename))
+        return bexts
+
+    for ig in todo:
+        h5g = h5f['data']['grid_' + str(ig).zfill(10)]
+        for name, bext in zip(dset_names, bexts):
+            dset = h5g[name][:, :, :].swapaxes(0, 2)
+            imin = np.unravel_index(np.argmin(dset, axis=None), dset.shape)
+            imax = np.unravel_index(np.argmax(dset, axis=None), dset.shape)
+            bext[ig] = True, dset[imin], dset[imax], imin, imax
+    save_extrema_cache(h5f.filename, cache)
+    return bexts
+
+
+def cached_block_extrema(h5f, bexts, ig):
+    blk = grid_index(h5f).blocks[ig]
+    bextrs, cextrs = [], []
+    for bext in bexts:
+        bextrs.append([bext['min'][ig], bext['max'][ig]])
+        cextrs.append([pu.block_cell_center(blk['left_edge'], blk['right_edge'], blk['n_b'], bext['imin'][ig]), pu.block_cell_center(blk['left_edge'], blk['right_edge'], blk['n_b'], bext['imax'][ig])])
+    return bextrs, cextrs
+
+
+def cached_uniform_extrema(h5f, bexts, level, gridlist):
+    # The same as reconstruct_uniform for extrema, None when the volume would not be fully covered by valid data
+    nd, loff, roff, ledg, redg, levelmet = frame_level(h5f, level, gridlist)
+    if not levelmet:
+        return False, [], []
+    gidx = grid_index(h5f)
+    mask = gidx.on_level(level, gridlist)
+    blks = gidx.blocks[mask]
+    if np.prod(blks['n_b'], axis=1).sum() != np.prod(nd):
+        return None
+    bextrs, cextrs = [], []
+    for bext in bexts:
+        be = bext[mask]
+        if np.isnan(be['min']).any() or np.isnan(be['max']).any():
+            return None
+        ext, loc = [], []
+        for key, ikey, val in (('min', 'imin', np.min(be['min'])), ('max', 'imax', np.max(be['max']))):
+            # the first occurrence in the uniform volume wins, as for np.argmin and np.argmax
+            i3 = (blks['off'] - loff + be[ikey])[be[key] == val]
+            i3 = i3[np.lexsort((i3[:, 2], i3[:, 1], i3[:, 0]))[0]]
+            ext.append(val)
+            loc.append(pu.block_cell_center(ledg, redg, nd, i3))
+        bextrs.append(ext)
+        cextrs.append(loc)
+    return True, bextrs, cextrs
+
+
+def collect_gridlevels(h5f, varlist, cmpr, maxglev, plotlevels, gridlist, cgcount, centers, usc, getmap, drawu, drawa, drawg, draw1D, draw2D, memlim, xcache, steps):
+    # all datasets from varlist are read at once from every visited block
+    nvar = len(varlist)
+    tofind = [iv for iv in range(nvar) if len(centers[iv]) != 3]
+    if tofind != []:
+        findlist = [varlist[iv] for iv in tofind]
+        curmin, curmax = [np.inf] * len(tofind), [-np.inf] * len(tofind)
+        locmin, locmax = [None] * len(tofind), [None] * len(tofind)
+        gidx = grid_index(h5f)
+        # compared data depend on the other file, so they are never cached
+        xcache = xcache and not cmpr[0]
+        if xcache:
+            bexts = block_extrema(h5f, findlist, gidx.ids(np.isin(gidx.blocks['level'], list(plotlevels)) & gidx.in_gridlist(gridlist)))
         lev_num = -1
         for iref in range(maxglev + 1):
             if iref in plotlevels:
                 lev_num += 1
-                blks = []
 
                 if drawu:
-                    levok, bextr, cextr = reconstruct_uniform(h5f, var, cmpr, lev_num, iref, gridlist, None, usc, draw1D, draw2D)
+                    uextr = None
+                    if xcache:
+                        uextr = cached_uniform_extrema(h5f, bexts, iref, gridlist)
+                    if uextr is None:
+                        uextr = reconstruct_uniform(h5f, findlist, cmpr, lev_num, iref, gridlist, None, usc, draw1D, draw2D, memlim, 1)
+                    levok, bextrs, cextrs = uextr
                     if levok:
-                        curmin, curmax, locmin, locmax = pu.check_extrema(curmin, curmax, locmin, locmax, bextr, cextr)
+                        for i in range(len(tofind)):
+                            curmin[i], curmax[i], locmin[i], locmax[i] = pu.check_extrema(curmin[i], curmax[i], locmin[i], locmax[i], bextrs[i], cextrs[i])
 
                 if drawa:
-                    for ib in gridlist:
-                        levok, bextr, cextr = read_block(h5f, var, cmpr, ib, iref, None, usc, (getmap and drawa), draw1D, draw2D)
+                    for ib in gidx.ids(gidx.on_level(iref, gridlist)):
+                        if xcache:
+                            levok = True
+                            bextrs, cextrs = cached_block_extrema(h5f, bexts, ib)
+                        else:
+                            levok, bextrs, cextrs = read_block(h5f, findlist, cmpr, ib, iref, None, usc, (getmap and drawa), draw1D, draw2D, 1)
                         if levok:
-                            curmin, curmax, locmin, locmax = pu.check_extrema(curmin, curmax, locmin, locmax, bextr, cextr)
-
-        print('Found in position: %s %s %s \tmin value %s' % (locmin[0], locmin[1], locmin[2], curmin))
-        print('Found in position: %s %s %s \tmax value %s' % (locmax[0], locmax[1], locmax[2], curmax))
-        if center[0]:
-            center = locmin
-        elif center[1]:
-            center = locmax
-        print('Plot center set to: %s %s %s' % center)
-
-    l1, h1, l2, h2, l3, h3 = [], [], [], [], [], []
+                            for i in range(len(tofind)):
+                                curmin[i], curmax[i], locmin[i], locmax[i] = pu.check_extrema(curmin[i], curmax[i], locmin[i], locmax[i], bextrs[i], cextrs[i])
+
+        centers = list(centers)
+        for i, iv in enumerate(tofind):
+            if nvar > 1:
+                print('Extrema of %s:' % varlist[iv])
+            print('Found in position: %s %s %s \tmin value %s' % (locmin[i][0], locmin[i][1], locmin[i][2], curmin[i]))
+            print('Found in position: %s %s %s \tmax value %s' % (locmax[i][0], locmax[i][1], locmax[i][2], curmax[i]))
+            if centers[iv][0]:
+                centers[iv] = locmin[i]
+            elif centers[iv][1]:
+                centers[iv] = locmax[i]
+            print('Plot center set to: %s %s %s' % centers[iv])
+
+    refises = [[] for iv in range(nvar)]
+    extrs = [[[], [], [], []] for iv in range(nvar)]
     lev_num = -1
     for iref in range(maxglev + 1):
         if iref in plotlevels:
             lev_num += 1
+            if steps != {} and iref not in steps:
+                print('REFINEMENT ', iref, 'omitted in preview')
+                continue
+            step = steps.get(iref, 1)
             print('REFINEMENT ', iref)
-            blks = []
+            blks = [[] for iv in range(nvar)]
 
             if drawu:
-                levok, block, extr = reconstruct_uniform(h5f, var, cmpr, lev_num, iref, gridlist, center, usc, draw1D, draw2D)
+                levok, blocks, bextrs = reconstruct_uniform(h5f, varlist, cmpr, lev_num, iref, gridlist, centers, usc, draw1D, draw2D, memlim, step)
                 if levok:
-                    blks.append(block)
-                    if getmap:
-                        l1.append(extr[0])
-                        h1.append(extr[1])
-                        l2.append(extr[2])
-                        h2.append(extr[3])
-                        l3.append(extr[4])
-                        h3.append(extr[5])
+                    for iv in range(nvar):
+                        blks[iv].append(blocks[iv])
+                        if getmap:
+                            for i in range(4):
+                                extrs[iv][i].append(bextrs[iv][i])
 
             if drawa or drawg:
-                for ib in gridlist:
-                    levok, block, extr = read_block(h5f, var, cmpr, ib, iref, center, usc, (getmap and drawa), draw1D, draw2D)
-                    if levok:
-                        blks.append(block)
-                        if getmap and drawa:
-                            l1.append(extr[0])
-                            h1.append(extr[1])
-                            l2.append(extr[2])
-                            h2.append(extr[3])
-                            l3.append(extr[4])
-                            h3.append(extr[5])
-            if blks != []:
-                refis.append(blks)
-    return refis, [l1, h1, l2, h2, l3, h3], center
-
-
-def read_block(h5f, dset_name, cmpr, ig, olev, oc, usc, getmap, draw1D, draw2D):
-    h5g = h5f['data']['grid_' + str(ig).zfill(10)]
-    level = h5g.attrs['level']
-    levok = (level == olev)
+                gidx = grid_index(h5f)
+                mask = gidx.on_level(iref, gridlist)
+                crossing = np.zeros(len(gidx), dtype=bool)
+                for center in centers:
+                    crossing |= gidx.crossing_cuts(center, draw1D, draw2D)
+                for ib in gidx.ids(mask & crossing):
+                    levok, blocks, bextrs = read_block(h5f, varlist, cmpr, ib, iref, centers, usc, (getmap and drawa), draw1D, draw2D, step)
+                    for iv in range(nvar):
+                        if levok[iv]:
+                            blks[iv].append(blocks[iv])
+                            if getmap and drawa:
+                                for i in range(4):
+                                    extrs[iv][i].append(bextrs[iv][i])
+            for iv in range(nvar):
+                if blks[iv] != []:
+                    refises[iv].append(blks[iv])
+    return refises, extrs, centers
+
+
+def read_block(h5f, dset_names, cmpr, ig, olev, ocs, usc, getmap, draw1D, draw2D, step):
+    # ocs is None when only extrema are requested, otherwise it lists plot centers for all dset_names
+    # cuts and lines are read taking every step-th cell
+    nvar = len(dset_names)
+    blk = grid_index(h5f).blocks[ig]
+    levok = (blk['level'] == olev)
     if not levok:
-        return levok, [], []
-
-    ledge = h5g.attrs['left_edge']
-    redge = h5g.attrs['right_edge']
-    ngb = h5g.attrs['n_b']
-    if oc is not None:
-        inb, ind = pu.find_indices(ngb, oc, ledge, redge, draw1D, draw2D, False)
-        if not any(inb):
+        if ocs is None:
             return False, [], []
-        if not getmap:
-            return levok, [[], inb, ledge / usc, redge / usc, olev, []], []
-    off = h5g.attrs['off']
-    n_b = [int(ngb[0]), int(ngb[1]), int(ngb[2])]
-    ce = n_b + off
-    dset = h5g[dset_name][:, :, :].swapaxes(0, 2)
+        return [False] * nvar, [[]] * nvar, [[]] * nvar
+
+    h5g = h5f['data']['grid_' + str(ig).zfill(10)]
+    ledge = blk['left_edge']
+    redge = blk['right_edge']
+    ngb = blk['n_b']
+    if ocs is not None:
+        inbs, inds = [], []
+        for oc in ocs:
+            inb, ind = pu.find_indices(ngb, oc, ledge, redge, draw1D, draw2D, False)
+            inbs.append(inb)
+            inds.append(ind)
+        levoks = [any(inb) for inb in inbs]
+        if not any(levoks) or not getmap:
+            return levoks, [[[], inb, ledge / usc, redge / usc, olev, []] for inb in inbs], [[]] * nvar
     cmpr0, cmprb, h5c, cmprd, cmprl, cmprt, diff_struct = cmpr
     if cmpr0:
-        dset = pu.execute_comparison(dset, h5c['data']['grid_' + str(ig).zfill(10)][cmprd][:, :, :].swapaxes(0, 2), cmprt)
-
-    if oc is None:
-        return pu.locate_extrema(dset, ledge, redge, ngb)
-
-    b2d, b1d, extr = take_cuts_and_lines(dset, ind, draw1D, draw2D)
+        h5dc = h5c['data']['grid_' + str(ig).zfill(10)][cmprd]
+    sls = strided_slices([0, 0, 0], ngb, step)[0]
+
+    blocks, extrs = [], []
+    for iv in range(nvar):
+        if ocs is None:
+            # extrema over the whole block are needed, so it has to be read entirely
+            dset = h5g[dset_names[iv]][:, :, :].swapaxes(0, 2)
+            if cmpr0:
+                dset = pu.execute_comparison(dset, h5dc[:, :, :].swapaxes(0, 2), cmprt)
+            levok, bextr, cextr = pu.locate_extrema(dset, ledge, redge, ngb)
+            blocks.append(bextr)
+            extrs.append(cextr)
+        elif not levoks[iv]:
+            blocks.append([])
+            extrs.append([])
+        else:
+            b2d, b1d = read_cuts_and_lines(h5g[dset_names[iv]], inds[iv], sls, draw1D, draw2D)
+            if cmpr0:
+                b2d, b1d = compare_cuts_and_lines([b2d, b1d], read_cuts_and_lines(h5dc, inds[iv], sls, draw1D, draw2D), cmprt, draw1D, draw2D)
+            blocks.append([b2d, inbs[iv], ledge / usc, redge / usc, olev, b1d])
+            extrs.append(cuts_and_lines_extrema(b2d, b1d, draw1D, draw2D))
 
-    return levok, [b2d, inb, ledge / usc, redge / usc, olev, b1d], extr
+    if ocs is None:
+        return levok, blocks, extrs
+    return levoks, blocks, extrs
 
 
-def take_cuts_and_lines(dset, ind, draw1D, draw2D):
-    xy, xz, yz, d2min, d2max = [], [], [], [], []
+def read_cuts_and_lines(h5ds, ind, sls, draw1D, draw2D):
+    # h5ds is a [z, y, x] ordered h5py dataset, only hyperslabs crossing ind are read, sls select [x, y, z] cells along them
+    xy, xz, yz = [], [], []
     if draw2D[2]:
-        xy = dset[:, :, ind[2]].swapaxes(0, 1)
-        d2min.append(np.min(xy))
-        d2max.append(np.max(xy))
+        xy = h5ds[ind[2], sls[1], sls[0]]
     if draw2D[1]:
-        xz = dset[:, ind[1], :].swapaxes(0, 1)
-        d2min.append(np.min(xz))
-        d2max.append(np.max(xz))
+        xz = h5ds[sls[2], ind[1], sls[0]]
     if draw2D[0]:
-        yz = dset[ind[0], :, :].swapaxes(0, 1)
-        d2min.append(np.min(yz))
-        d2max.append(np.max(yz))
+        yz = h5ds[sls[2], sls[1], ind[0]]
 
-    fx, fy, fz, d1min, d1max = [], [], [], [], []
+    fx, fy, fz = [], [], []
     if draw1D[0]:
-        fx = dset[:, ind[1], ind[2]]
-        d1min.append(np.min(fx))
-        d1max.append(np.max(fx))
+        fx = h5ds[ind[2], ind[1], sls[0]]
     if draw1D[1]:
-        fy = dset[ind[0], :, ind[2]]
-        d1min.append(np.min(fy))
-        d1max.append(np.max(fy))
+        fy = h5ds[ind[2], sls[1], ind[0]]
     if draw1D[2]:
-        fz = dset[ind[0], ind[1], :]
-        d1min.append(np.min(fz))
-        d1max.append(np.max(fz))
+        fz = h5ds[sls[2], ind[1], ind[0]]
+
+    return [yz, xz, xy], [fx, fy, fz]
+
+
+def compare_cuts_and_lines(cut, ccut, cmprt, draw1D, draw2D):
+    b2d, b1d = list(cut[0]), list(cut[1])
+    for i in range(3):
+        if draw2D[i]:
+            b2d[i] = pu.execute_comparison(b2d[i], ccut[0][i], cmprt)
+        if draw1D[i]:
+            b1d[i] = pu.execute_comparison(b1d[i], ccut[1][i], cmprt)
+    return b2d, b1d
+
+
+def cuts_and_lines_extrema(b2d, b1d, draw1D, draw2D):
+    d2min, d2max, d1min, d1max = [], [], [], []
+    for i in (2, 1, 0):
+        if draw2D[i]:
+            d2min.append(np.min(b2d[i]))
+            d2max.append(np.max(b2d[i]))
+    for i in range(3):
+        if draw1D[i]:
+            d1min.append(np.min(b1d[i]))
+            d1max.append(np.max(b1d[i]))
 
-    d3min, d3max = np.min(dset), np.max(dset)
     if any(draw2D):
         d2max = max(d2max)
         d2min = min(d2min)
@@ -317,44 +632,48 @@ def take_cuts_and_lines(dset, ind, draw1D, draw2D):
         d1max = max(d1max)
         d1min = min(d1min)
 
-    return [yz, xz, xy], [fx, fy, fz], [d1min, d1max, d2min, d2max, d3min, d3max]
+    return [d1min, d1max, d2min, d2max]
 
 
 def collect_particles(h5f, drawh, center, player, uupd, usc, plotlevels, gridlist):
     if 'particle_types' not in list(h5f):
         return False, [], []
     print('Reading particles')
-    px, py, pz, pm = np.array([]), np.array([]), np.array([]), np.array([])
-    for gn in h5f['data']:
-        if h5f['data'][gn].attrs['level'] in plotlevels and int(gn.split('grid_')[-1]) in gridlist:
-            if str(player[1]) == '0' and str(player[2]) == '0' and str(player[3]) == '0':
-                px = np.concatenate((px, h5f['data'][gn]['particles'][ps.particles_group]['position_x'][:]))
-                py = np.concatenate((py, h5f['data'][gn]['particles'][ps.particles_group]['position_y'][:]))
-                pz = np.concatenate((pz, h5f['data'][gn]['particles'][ps.particles_group]['position_z'][:]))
-                if drawh:
-                    pm = np.concatenate((pm, h5f['data'][gn]['particles'][ps.particles_group]['mass'][:]))
+    gidx = grid_index(h5f)
+    ids = gidx.ids(np.isin(gidx.blocks['level'], list(plotlevels)) & gidx.in_gridlist(gridlist) & (gidx.blocks['n_part'] != 0))
+    h5ps = [h5f['data']['grid_' + str(ig).zfill(10)]['particles'][ps.particles_group] for ig in ids]
+    counts = [int(npart) if npart >= 0 else h5p['position_x'].shape[0] for npart, h5p in zip(gidx.blocks['n_part'][ids], h5ps)]
+
+    columns = ['position_x', 'position_y', 'position_z']
+    if drawh:
+        columns.append('mass')
+    pdata = np.empty((len(columns), sum(counts)))
+    whole = str(player[1]) == '0' and str(player[2]) == '0' and str(player[3]) == '0'
+    if player[0]:
+        whole = whole or str(player[1]) == '0' or str(player[2]) == '0' or str(player[3]) == '0'
+    widths = [float(player[1]), float(player[2]), float(player[3])]
+
+    nread = 0
+    for h5p, npart in zip(h5ps, counts):
+        if whole:
+            for ic, col in enumerate(columns):
+                h5p[col].read_direct(pdata[ic], dest_sel=np.s_[nread:nread + npart])
+            nread += npart
+        else:
+            bdata = np.array([h5p[col][:] for col in columns], dtype=float)
+            inslab = np.abs(bdata[:3, :] - np.reshape(center, (3, 1))) <= np.reshape(widths, (3, 1))
+            if player[0]:
+                mask = inslab.any(axis=0)
             else:
-                apx = h5f['data'][gn]['particles'][ps.particles_group]['position_x'][:]
-                apy = h5f['data'][gn]['particles'][ps.particles_group]['position_y'][:]
-                apz = h5f['data'][gn]['particles'][ps.particles_group]['position_z'][:]
-                maskx = np.abs(apx - center[0]) <= float(player[1])
-                masky = np.abs(apy - center[1]) <= float(player[2])
-                maskz = np.abs(apz - center[2]) <= float(player[3])
-                if player[0]:
-                    auxm = str(player[1]) == '0' or str(player[2]) == '0' or str(player[3]) == '0'
-                    for i in range(np.size(maskx)):
-                        maskx[i] = maskx[i] or masky[i] or maskz[i] or auxm
-                else:
-                    for i in range(np.size(maskx)):
-                        maskx[i] = maskx[i] and masky[i] and maskz[i]
-                px = np.concatenate((px, apx[maskx]))
-                py = np.concatenate((py, apy[maskx]))
-                pz = np.concatenate((pz, apz[maskx]))
-                if drawh:
-                    pm = np.concatenate((pm, h5f['data'][gn]['particles'][ps.particles_group]['mass'][maskx]))
-
-    if px.size == 0:
+                mask = inslab.all(axis=0)
+            nsel = np.count_nonzero(mask)
+            pdata[:, nread:nread + nsel] = bdata[:, mask]
+            nread += nsel
+
+    if nread == 0:
         return False, [], []
+    px, py, pz = pdata[0, :nread], pdata[1, :nread], pdata[2, :nread]
+    pm = pdata[3, :nread] if drawh else np.array([])
     if uupd:
         return True, pu.list3_division([px, py, pz], usc), pm
 